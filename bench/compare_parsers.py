@@ -0,0 +1,75 @@
+"""Checks that --parser lxml gives the same records as the default html.parser
+
+Parses every .html file in a Takeout folder with both and prints any file where the records
+differ. Without a folder, it checks a tree from generate_takeout.py plus a file of cases the lxml
+serializer has to get right, eg <q> contents with elements whose attributes aren't in order.
+"""
+
+import argparse
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from generate_takeout import generate_takeout, get_message_html, html_head, html_tail
+
+repo_dir = Path(__file__).resolve().parent.parent
+
+# Message texts BeautifulSoup writes out in its own way: attributes sorted by name, multi-valued
+# attributes normalized, void elements closed, entities and quotes in attribute values
+tricky_texts = [
+    'go to <a rel="nofollow" href="http://x.com/?a=1&amp;b=2">x.com</a>',
+    '<img src="a.jpg" alt="b" class="c  d" />',
+    "<span title='say \"hi\"' class=\"x\">it's</span><br>after<br />",
+    "a &lt;b&gt; &amp; c <!-- a comment --> d",
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "takeout_dir", nargs="?", help="folder to check (default: a generated tree)"
+    )
+    args = parser.parse_args()
+
+    sys.path.insert(0, str(repo_dir))
+    import sms
+
+    if args.takeout_dir:
+        differences = compare(sms, Path(args.takeout_dir))
+    else:
+        with TemporaryDirectory() as takeout_dir:
+            generate_takeout(Path(takeout_dir), threads=20, groups=5, call_logs=40)
+            write_tricky_file(Path(takeout_dir) / "Takeout" / "Voice" / "Calls")
+            differences = compare(sms, Path(takeout_dir))
+    sys.exit(1 if differences else 0)
+
+
+def write_tricky_file(calls_dir):
+    body = '<div class="hChatLog hfeed">\n'
+    for i, text in enumerate(tricky_texts):
+        time = f"2020-01-01T10:00:{i:02d}.000-05:00"
+        body += get_message_html(time, False, "+15550000001", "Contact 1", text, "")
+    body += "</div>\n"
+    html = html_head.format(title="Me to Contact 1") + body + html_tail
+    (calls_dir / "Contact 1 - Text - 2020-01-01T15_00_00Z.html").write_text(html, encoding="utf8")
+
+
+def compare(sms, takeout_dir):
+    """Print the files the two parsers disagree on, returning how many there were"""
+    paths = sorted(takeout_dir.glob("**/*.html"))
+    differences = 0
+    for path in paths:
+        soup_records = sms.parse_html_soup(path)
+        lxml_records = sms.parse_html_lxml(path)
+        if soup_records != lxml_records:
+            differences += 1
+            print(f"Different records for {path}")
+            for soup_message, lxml_message in zip(soup_records.messages, lxml_records.messages):
+                if soup_message != lxml_message:
+                    print(f"  html.parser: {soup_message}\n  lxml:        {lxml_message}")
+    print(f"Compared {len(paths)} files, {differences} with different records")
+    return differences
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+"""Writes a synthetic Google Voice Takeout tree for benchmarking sms.py
+
+The tree has one-to-one text threads, group conversations and call logs, with attachments of a
+chosen size and type. The attachments cover the naming cases find_attachment handles: the plain
+file name, a src without its extension, a src starting with the contact's name where the file
+starts with their number, and threads repeated as foo(0).html, foo(1).html. The same seed always
+gives the same tree.
+"""
+
+import argparse
+import random
+from datetime import datetime, timedelta
+from pathlib import Path
+
+html_head = (
+    '<?xml version="1.0" ?>\n'
+    '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" '
+    '"http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">\n'
+    '<html xmlns="http://www.w3.org/1999/xhtml">\n'
+    "<head>\n"
+    '<meta http-equiv="Content-Type" content="text/html; charset=utf-8" />\n'
+    "<title>{title}</title>\n"
+    "</head>\n"
+    "<body>\n"
+)
+html_tail = "</body></html>\n"
+
+message_bodies = [
+    "Hello",
+    "On my way, see you in 10",
+    "a &amp; b &lt;c&gt; &quot;quoted&quot; 'single'",
+    "line one<br />line two",
+    'see <a href="http://example.com/?a=1&amp;b=2">example.com</a>',
+    "emoji 😀🎉",
+    "Can you call me back when you get a chance? It's about Saturday.",
+]
+
+attachment_kinds = {
+    "jpg": "image",
+    "png": "image",
+    "gif": "image",
+    "mp4": "video",
+    "3gp": "video",
+    "mp3": "audio",
+    "amr": "audio",
+}
+
+# Every file name gets its own time, so the resolver never finds two candidates
+start_time = datetime(2019, 1, 1, 8, 0, 0)
+
+my_number = "+15550000000"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("out_dir", help="directory to create the Takeout folder in")
+    parser.add_argument("--threads", type=int, default=100, help="one-to-one text threads")
+    parser.add_argument("--groups", type=int, default=10, help="group conversations")
+    parser.add_argument("--call-logs", type=int, default=300, help="call log files")
+    parser.add_argument(
+        "--messages", type=int, default=20, help="messages in each thread and group conversation"
+    )
+    parser.add_argument(
+        "--attachment-rate",
+        type=float,
+        default=0.1,
+        help="fraction of messages with an attachment (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--attachment-size", type=int, default=64, metavar="KB", help="size of each attachment"
+    )
+    parser.add_argument(
+        "--attachment-types",
+        default="jpg,gif,mp4,amr",
+        help=f"comma separated, from {','.join(attachment_kinds)} (default: %(default)s)",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    attachment_types = args.attachment_types.split(",")
+    for attachment_type in attachment_types:
+        if attachment_type not in attachment_kinds:
+            parser.error(f"Unknown attachment type: {attachment_type}")
+
+    stats = generate_takeout(
+        Path(args.out_dir),
+        threads=args.threads,
+        groups=args.groups,
+        call_logs=args.call_logs,
+        messages=args.messages,
+        attachment_rate=args.attachment_rate,
+        attachment_size=args.attachment_size * 1024,
+        attachment_types=attachment_types,
+        seed=args.seed,
+    )
+    print(
+        f"Wrote {stats['files']} .html files with {stats['messages']} messages and "
+        f"{stats['attachments']} attachments to {args.out_dir}"
+    )
+
+
+def generate_takeout(
+    out_dir,
+    threads=100,
+    groups=10,
+    call_logs=300,
+    messages=20,
+    attachment_rate=0.1,
+    attachment_size=64 * 1024,
+    attachment_types=("jpg", "gif", "mp4", "amr"),
+    seed=1,
+):
+    """Write the tree under out_dir/Takeout/Voice/Calls. Returns counts of what was written."""
+    generator = TakeoutGenerator(
+        out_dir / "Takeout" / "Voice" / "Calls",
+        random.Random(seed),
+        messages,
+        attachment_rate,
+        attachment_size,
+        list(attachment_types),
+    )
+    for thread in range(threads):
+        generator.write_thread(thread)
+    for group in range(groups):
+        generator.write_group(group, threads)
+    for call_log in range(call_logs):
+        generator.write_call_log(call_log, threads)
+    return generator.stats
+
+
+class TakeoutGenerator:
+    def __init__(
+        self, calls_dir, rng, messages, attachment_rate, attachment_size, attachment_types
+    ):
+        self.calls_dir = calls_dir
+        self.rng = rng
+        self.messages = messages
+        self.attachment_rate = attachment_rate
+        self.attachment_size = attachment_size
+        self.attachment_types = attachment_types
+        self.file_number = 0
+        self.stats = {"files": 0, "messages": 0, "attachments": 0, "bytes": 0}
+        calls_dir.mkdir(parents=True, exist_ok=True)
+
+    def write_thread(self, thread):
+        number, name = get_contact(thread)
+        # Takeout names the files after the contact when it has a name for them
+        named = thread % 2 == 1
+        prefix = name if named else number
+        stem = f"{prefix} - Text - {self._next_file_time()}"
+
+        body = '<div class="hChatLog hfeed">\n'
+        for i in range(self.messages):
+            sent_by_me = self.rng.random() < 0.4
+            media = self._attachment(stem, i, number if named else None)
+            body += get_message_html(
+                self._next_message_time(), sent_by_me, number, name, self._text(), media
+            )
+        body += "</div>\n"
+
+        # Long threads are split over foo(0).html, foo(1).html, ... all sharing the attachments
+        if thread % 10 == 9:
+            for part in range(2):
+                self._write_html(f"{stem}({part}).html", f"Me to {name}", body, self.messages)
+        else:
+            self._write_html(f"{stem}.html", f"Me to {name}", body, self.messages)
+
+    def write_group(self, group, threads):
+        stem = f"Group Conversation - {self._next_file_time()}"
+        participants = [
+            get_contact((group * 3 + i) % max(threads, 1)) for i in range(3 + group % 3)
+        ]
+
+        body = '<div class="participants">Group conversation with:\n'
+        body += ", ".join(
+            f'<cite class="sender vcard"><a class="tel" href="tel:{number}">'
+            f'<span class="fn">{name}</span></a></cite>'
+            for number, name in participants
+        )
+        body += '</div>\n<div class="hChatLog hfeed">\n'
+        for i in range(self.messages):
+            number, name = self.rng.choice(participants)
+            sent_by_me = self.rng.random() < 0.3
+            media = self._attachment(stem, i)
+            body += get_message_html(
+                self._next_message_time(), sent_by_me, number, name, self._text(), media
+            )
+        body += "</div>\n"
+        self._write_html(f"{stem}.html", "Group Conversation", body, self.messages)
+
+    def write_call_log(self, call_log, threads):
+        number, name = get_contact(call_log % max(threads, 1))
+        kind = ["Placed", "Received", "Missed", "Voicemail"][call_log % 4]
+        prefix = name if call_log % 3 else number
+        stem = f"{prefix} - {kind} - {self._next_file_time()}"
+
+        body = (
+            f'<div class="haudio"><span class="fn">{kind} call</span>\n'
+            f'<div class="contributor vcard">{kind} call from\n'
+            f'<a class="tel" href="tel:{number}"><span class="fn">{name}</span></a></div>\n'
+            f'<abbr class="published" title="{self._next_message_time()}">x</abbr>\n'
+        )
+        if kind == "Voicemail":
+            self._write_attachment(f"{stem}.mp3")
+            body += (
+                f'<span class="full-text">{self._text()}</span>'
+                f'<audio controls="controls" src="{stem}.mp3">'
+                f'<a rel="enclosure" href="{stem}.mp3">Audio</a></audio>\n'
+            )
+        body += "</div>"
+        self._write_html(f"{stem}.html", kind, body, 1)
+
+    def _attachment(self, stem, i, number=None):
+        if self.rng.random() >= self.attachment_rate:
+            return ""
+        attachment_type = self.rng.choice(self.attachment_types)
+        name = f"{stem}-{i}-1"
+        filename = f"{name}.{attachment_type}"
+        src = filename
+
+        naming_case = self.stats["attachments"] % 3
+        if naming_case == 1:
+            # No extension in the HTML
+            src = name
+        elif naming_case == 2 and number is not None:
+            # The HTML starts with the contact's name but the file with their number
+            filename = number + filename[filename.index(" - "):]
+
+        self._write_attachment(filename)
+        kind = attachment_kinds[attachment_type]
+        if kind == "image":
+            return f'<div><img src="{src}" alt="Image MMS Attachment" /></div>'
+        if kind == "video":
+            return f'<div><a class="video" href="{src}">Video MMS Attachment</a></div>'
+        return f'<div><audio controls="controls" src="{src}"></audio></div>'
+
+    def _write_attachment(self, filename):
+        size = self.attachment_size
+        # Random.randbytes needs Python 3.9
+        data = self.rng.getrandbits(8 * size).to_bytes(size, "little") if size else b""
+        (self.calls_dir / filename).write_bytes(data)
+        self.stats["attachments"] += 1
+        self.stats["bytes"] += self.attachment_size
+
+    def _write_html(self, filename, title, body, num_messages):
+        html = html_head.format(title=title) + body + html_tail
+        (self.calls_dir / filename).write_text(html, encoding="utf8")
+        self.stats["files"] += 1
+        self.stats["messages"] += num_messages
+        self.stats["bytes"] += len(html.encode("utf8"))
+
+    def _text(self):
+        return self.rng.choice(message_bodies)
+
+    def _next_file_time(self):
+        self.file_number += 1
+        return (start_time + timedelta(minutes=self.file_number)).strftime("%Y-%m-%dT%H_%M_%SZ")
+
+    def _next_message_time(self):
+        # Takeout writes local times with their offset, so both sides of a DST change show up
+        time = start_time + timedelta(seconds=self.rng.randrange(3 * 365 * 24 * 3600))
+        offset = "-04:00" if 3 < time.month < 11 else "-05:00"
+        milliseconds = self.rng.randrange(1000)
+        return time.strftime("%Y-%m-%dT%H:%M:%S") + f".{milliseconds:03d}{offset}"
+
+
+def get_contact(i):
+    return f"+1555{i + 1:07d}", f"Contact {i + 1}"
+
+
+def get_message_html(time, sent_by_me, number, name, text, media):
+    if sent_by_me:
+        cite = (
+            f'<cite class="sender vcard"><a class="tel" href="tel:{my_number}">'
+            '<abbr class="fn" title="">Me</abbr></a></cite>'
+        )
+    else:
+        cite = (
+            f'<cite class="sender vcard"><a class="tel" href="tel:{number}">'
+            f'<span class="fn">{name}</span></a></cite>'
+        )
+    return (
+        f'<div class="message"><abbr class="dt" title="{time}">x</abbr>:\n'
+        f"{cite}:\n<q>{text}</q>{media}\n</div>\n"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+"""Times sms.py on synthetic Takeout trees of different sizes
+
+Each size is a tree from generate_takeout.py, converted in a fresh process so peak memory is per
+run. Reports messages/sec, MB/sec, peak RSS and the time spent in each stage, and saves it all as
+JSON that a later run can be compared against with --compare.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from contextlib import redirect_stdout
+from datetime import datetime
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from generate_takeout import attachment_kinds, generate_takeout
+
+repo_dir = Path(__file__).resolve().parent.parent
+
+# The sms.py functions whose time counts toward each stage. When one of them calls another (eg the
+# fallback number search parsing a file), the time counts toward the inner one only.
+stage_functions = {
+    "walk": ["get_sms_filenames"],
+    "parse": ["parse_takeout_file"],
+    "resolve": ["find_attachment", "get_fallback_phone_number"],
+    "encode": ["encode_attachment"],
+    "write": ["BackupWriter.write", "BackupWriter.write_file", "BackupWriter.close"],
+    "header": ["write_header", "count_messages"],
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes",
+        default="50,200,1000",
+        help="comma separated numbers of one-to-one threads. Each size also gets a tenth as many "
+        "group conversations and three times as many call logs (default: %(default)s)",
+    )
+    parser.add_argument("--messages", type=int, default=20, help="messages in each conversation")
+    parser.add_argument("--attachment-rate", type=float, default=0.1)
+    parser.add_argument("--attachment-size", type=int, default=64, metavar="KB")
+    parser.add_argument("--attachment-types", default="jpg,gif,mp4,amr")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="runs of each size, the fastest is reported"
+    )
+    parser.add_argument(
+        "--sms-args",
+        default="",
+        help='options passed on to sms.py, eg --sms-args="--parser lxml". Stage times only cover '
+        "the main process, so they leave out the work done by --jobs workers",
+    )
+    parser.add_argument(
+        "--output",
+        default="bench-results.json",
+        help="file to save the results in (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--compare", metavar="RESULTS", help="results of an earlier run to compare with"
+    )
+    parser.add_argument(
+        "--work-dir", help="where to generate the trees (default: the system temporary directory)"
+    )
+    # Used by the benchmark itself to time one conversion in a fresh process
+    parser.add_argument("--measure", metavar="TAKEOUT_DIR", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure(Path(args.measure), args.sms_args.split())))
+        return
+
+    for attachment_type in args.attachment_types.split(","):
+        if attachment_type not in attachment_kinds:
+            parser.error(f"Unknown attachment type: {attachment_type}")
+
+    results = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "sms_args": args.sms_args,
+        "repeat": args.repeat,
+        "runs": [],
+    }
+    for size in [int(size) for size in args.sizes.split(",")]:
+        run = benchmark_size(size, args)
+        results["runs"].append(run)
+        print_run(run)
+
+    with open(args.output, "w", encoding="utf8") as results_file:
+        json.dump(results, results_file, indent=2)
+    print("Results saved to " + args.output)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf8") as baseline_file:
+            print_comparison(json.load(baseline_file), results)
+
+
+def benchmark_size(size, args):
+    corpus = {
+        "threads": size,
+        "groups": max(size // 10, 1),
+        "call_logs": size * 3,
+        "messages": args.messages,
+        "attachment_rate": args.attachment_rate,
+        "attachment_size": args.attachment_size * 1024,
+        "attachment_types": args.attachment_types.split(","),
+        "seed": args.seed,
+    }
+    with TemporaryDirectory(dir=args.work_dir) as takeout_dir:
+        print(f"Generating {size} threads")
+        stats = generate_takeout(Path(takeout_dir), **corpus)
+
+        measurements = []
+        for _ in range(args.repeat):
+            command = [sys.executable, __file__, "--measure", takeout_dir]
+            output = subprocess.run(
+                command + [f"--sms-args={args.sms_args}"],
+                check=True,
+                stdout=subprocess.PIPE,
+                text=True,
+            ).stdout
+            measurements.append(json.loads(output.splitlines()[-1]))
+
+    best = min(measurements, key=lambda measurement: measurement["seconds"])
+    seconds = best["seconds"]
+    input_mb = stats["bytes"] / 1024 / 1024
+    return dict(
+        corpus,
+        files=stats["files"],
+        total_messages=stats["messages"],
+        attachments=stats["attachments"],
+        input_mb=round(input_mb, 3),
+        output_mb=round(best["output_bytes"] / 1024 / 1024, 3),
+        seconds=round(seconds, 4),
+        all_seconds=[round(measurement["seconds"], 4) for measurement in measurements],
+        messages_per_sec=round(stats["messages"] / seconds, 1),
+        input_mb_per_sec=round(input_mb / seconds, 3),
+        output_mb_per_sec=round(best["output_bytes"] / 1024 / 1024 / seconds, 3),
+        peak_rss_mb=max_or_none(measurement["peak_rss_mb"] for measurement in measurements),
+        stages={stage: round(seconds, 4) for stage, seconds in best["stages"].items()},
+    )
+
+
+def measure(takeout_dir, sms_args):
+    """Convert takeout_dir once in this process, with every stage timed"""
+    sys.path.insert(0, str(repo_dir))
+    import sms
+
+    stage_timer = sms.RunStats(stage_functions)
+    stage_timer.install()
+
+    os.chdir(takeout_dir)
+    before = set(os.listdir("."))
+    sys.argv = ["sms.py"] + sms_args
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        sms.main()
+    seconds = time.perf_counter() - start
+
+    output_files = [
+        filename
+        for filename in set(os.listdir(".")) - before
+        if filename.startswith("gvoice-") and not filename.endswith(".manifest")
+    ]
+    output_bytes = sum(os.path.getsize(filename) for filename in output_files)
+    for filename in os.listdir("."):
+        if filename not in before:
+            os.remove(filename)
+
+    peak_memory = sms.get_peak_memory_mb(children=True)
+    stages = {
+        stage: sum(stage_timer.seconds[name] for name in function_names)
+        for stage, function_names in stage_functions.items()
+    }
+    stages["other"] = seconds - sum(stages.values())
+    return {
+        "seconds": seconds,
+        "output_bytes": output_bytes,
+        "peak_rss_mb": None if peak_memory is None else round(peak_memory, 1),
+        "stages": stages,
+    }
+
+
+def max_or_none(values):
+    values = [value for value in values if value is not None]
+    return max(values) if values else None
+
+
+def print_run(run):
+    rss = "?" if run["peak_rss_mb"] is None else f"{run['peak_rss_mb']:.0f}"
+    print(
+        f"{run['threads']} threads: {run['total_messages']} messages, {run['input_mb']:.1f} MB in "
+        f"{run['seconds']:.2f}s. {run['messages_per_sec']:,.0f} messages/sec, "
+        f"{run['input_mb_per_sec']:.1f} MB/sec, peak RSS {rss} MB"
+    )
+    print(
+        "  "
+        + ", ".join(
+            f"{stage} {seconds:.2f}s ({seconds / run['seconds']:.0%})"
+            for stage, seconds in run["stages"].items()
+        )
+    )
+
+
+def print_comparison(baseline, results):
+    print(f"Compared with {baseline['created']} ({baseline['sms_args'] or 'no options'}):")
+    baseline_runs = {run["threads"]: run for run in baseline["runs"]}
+    for run in results["runs"]:
+        baseline_run = baseline_runs.get(run["threads"])
+        if baseline_run is None:
+            continue
+        print(
+            f"{run['threads']} threads: {baseline_run['seconds']:.2f}s -> {run['seconds']:.2f}s, "
+            f"{baseline_run['seconds'] / run['seconds']:.2f}x"
+        )
+        for stage, seconds in run["stages"].items():
+            baseline_seconds = baseline_run["stages"].get(stage)
+            if baseline_seconds is not None:
+                print(f"  {stage}: {baseline_seconds:.2f}s -> {seconds:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,552 +1,3239 @@
-import dateutil.parser
-import os
-import phonenumbers
-import re
-import time
-from base64 import b64encode
-from bs4 import BeautifulSoup
-from io import open  # adds emoji support
-from pathlib import Path
-from shutil import copyfileobj, move
-from tempfile import NamedTemporaryFile
-
-sms_backup_filename = "./gvoice-all.xml"
-sms_backup_path = Path(sms_backup_filename)
-# Clear file if it already exists
-sms_backup_path.open("w").close()
-print("New file will be saved to " + sms_backup_filename)
-
-
-def main():
-    print("Checking directory for *.html files")
-    num_sms = 0
-    root_dir = "."
-
-    for subdir, dirs, files in os.walk(root_dir):
-        for file in files:
-            sms_filename = os.path.join(subdir, file)
-
-            if os.path.splitext(sms_filename)[1] != ".html":
-                # print(sms_filename,"- skipped")
-                continue
-
-            print("Processing " + sms_filename)
-
-            is_group_conversation = re.match(r"(^Group Conversation)", file)
-
-            with open(sms_filename, "r", encoding="utf8") as sms_file:
-                soup = BeautifulSoup(sms_file, "html.parser")
-
-            messages_raw = soup.find_all(class_="message")
-
-            if len(messages_raw):
-                num_sms += len(messages_raw)
-
-                if is_group_conversation:
-                    participants_raw = soup.find_all(class_="participants")
-                    write_mms_messages(file, participants_raw, messages_raw)
-                else:
-                    write_sms_messages(file, messages_raw)
-
-            call_log_messages_raw = soup.find_all(class_="haudio")
-            if len(call_log_messages_raw):
-                num_sms += len(call_log_messages_raw)
-
-                write_sms_messages(file, call_log_messages_raw)
-
-    sms_backup_file = open(sms_backup_filename, "a")
-    sms_backup_file.write("</smses>")
-    sms_backup_file.close()
-
-    write_header(sms_backup_filename, num_sms)
-
-
-def write_sms_messages(file, messages_raw):
-    fallback_number = 0
-    title_has_number = re.search(r"(^\+[0-9]+)", Path(file).name)
-    if title_has_number:
-        fallback_number = title_has_number.group()
-
-    phone_number, participant_raw = get_first_phone_number(
-        messages_raw, fallback_number
-    )
-
-    # Search similarly named files for a fallback number. This is desperate and expensive, but
-    # hopefully rare.
-    if phone_number == 0:
-        file_prefix = "-".join(Path(file).stem.split("-")[0:1])
-        for fallback_file in Path.cwd().glob(f"**/{file_prefix}*.html"):
-            with fallback_file.open("r", encoding="utf8") as ff:
-                soup = BeautifulSoup(ff, "html.parser")
-            messages_raw_ff = soup.find_all(class_="message")
-            phone_number, participant_raw = get_first_phone_number(
-                messages_raw_ff, 0)
-            if phone_number != 0:
-                break
-
-    # Start looking in the Placed/Received files for a fallback number
-    if phone_number == 0:
-        file_prefix = f'{Path(file).stem.split("-")[0]}- '
-        for fallback_file in Path.cwd().glob(f"**/{file_prefix}*.html"):
-            with fallback_file.open("r", encoding="utf8") as ff:
-                soup = BeautifulSoup(ff, "html.parser")
-            vcards = soup.find_all(class_="contributor vcard")
-            phone_number_ff = 0
-            for vcard in vcards:
-                phone_number_ff = vcard.a["href"][4:]
-            phone_number, participant_raw = get_first_phone_number(
-                [], phone_number_ff)
-            if phone_number != 0:
-                break
-
-    sms_values = {"phone": phone_number}
-
-    sms_backup_file = open(sms_backup_filename, "a", encoding="utf8")
-    for message in messages_raw:
-        # Check if message has an image in it and treat as mms if so
-        if message.find_all("img") or message.find_all("a", class_='video') or message.find_all("audio"):
-            write_mms_messages(file, [[participant_raw]], [message])
-            continue
-
-        sms_values["type"] = get_message_type(message)
-        sms_values["message"] = get_message_text(message)
-        sms_values["time"] = get_message_time_unix(message)
-        sms_text = (
-            '<sms protocol="0" address="%(phone)s" '
-            'date="%(time)s" type="%(type)s" '
-            'subject="null" body="%(message)s" '
-            'toa="null" sc_toa="null" service_center="null" '
-            'read="1" status="1" locked="0" /> \n' % sms_values
-        )
-        sms_backup_file.write(sms_text)
-
-    sms_backup_file.close()
-
-
-def write_mms_messages(file, participants_raw, messages_raw):
-    sms_backup_file = open(sms_backup_filename, "a", encoding="utf8")
-
-    participants = get_participant_phone_numbers(participants_raw)
-    participants_text = "~".join(participants)
-
-    for message in messages_raw:
-        # Sometimes the sender tel field is blank. Try to guess the sender from the participants.
-        sender = get_mms_sender(message, participants)
-        sent_by_me = sender not in participants
-
-        # Handle images
-        images = message.find_all("img")
-        image_parts = ""
-        if images:
-            for image in images:
-                # I have only encountered jpg and gif, but I have read that GV can ecxport png
-                supported_types = ["jpg", "png", "gif"]
-                image_filename = image["src"]
-                original_image_filename = image_filename
-                # Each image found should only match a single file
-                image_path = list(Path.cwd().glob(f"**/*{image_filename}"))
-
-                if len(image_path) == 0:
-                    # Sometimes they just forget the extension
-                    for supported_type in supported_types:
-                        image_path = list(
-                            Path.cwd().glob(
-                                f"**/*{image_filename}.{supported_type}")
-                        )
-                        if len(image_path) == 1:
-                            break
-
-                if len(image_path) == 0:
-                    # Sometimes the first word doesn't match (eg it is a phone number instead of a
-                    # contact name) so try again without the first word
-                    image_filename = "-".join(
-                        original_image_filename.split("-")[1:])
-                    image_path = list(Path.cwd().glob(
-                        f"**/*{image_filename}*"))
-
-                if len(image_path) == 0:
-                    # Sometimes the image filename matches the message filename instead of the
-                    # filename in the HTML. And sometimes the message filenames are repeated, eg
-                    # filefoo(0).html, filefoo(1).html, etc., but the image filename matches just
-                    # the base ("filefoo" in this example).
-                    image_filenames = [Path(file).stem, Path(
-                        file).stem.split("(")[0]]
-                    for image_filename in image_filenames:
-                        # Have to guess at the file extension in this case
-                        for supported_type in supported_types:
-                            image_path = list(
-                                Path.cwd().glob(
-                                    f"**/*{image_filename}*.{supported_type}"
-                                )
-                            )
-                            # Sometimes there's extra cruft in the filename in the HTML. So try to
-                            # match a subset of it.
-                            if len(image_path) > 1:
-                                for ip in image_path:
-                                    if ip.stem in original_image_filename:
-                                        image_path = [ip]
-                                        break
-
-                            if len(image_path) == 1:
-                                break
-                        if len(image_path) == 1:
-                            break
-
-                assert (
-                    len(image_path) != 0
-                ), f"No matching images found. File name: {original_image_filename}"
-                assert (
-                    len(image_path) == 1
-                ), f"Multiple potential matching images found. Images: {[x for x in image_path]!r}"
-
-                image_path = image_path[0]
-                image_type = image_path.suffix[1:]
-                image_type = "jpeg" if image_type == "jpg" else image_type
-
-                with image_path.open("rb") as fb:
-                    image_bytes = fb.read()
-                byte_string = f"{b64encode(image_bytes)}"
-
-                image_parts += (
-                    f'    <part seq="0" ct="image/{image_type}" name="{image_path.name}" '
-                    f'chset="null" cd="null" fn="null" cid="&lt;{image_path.name}&gt;" '
-                    f'cl="{image_path.name}" ctt_s="null" ctt_t="null" text="null" '
-                    f'data="{byte_string[2:-1]}" />\n'
-                )
-
-        # Handle videos
-        videos = message.find_all("a", class_='video')
-        video_parts = ""
-        if videos:
-            for video in videos:
-                supported_types = ["mp4", "3gp"]
-                video_filename = video["href"]
-                original_video_filename = video_filename
-                # Each video found should only match a single file
-                video_path = list(Path.cwd().glob(f"**/*{video_filename}"))
-
-                if len(video_path) == 0:
-                    # Sometimes they just forget the extension
-                    for supported_type in supported_types:
-                        video_path = list(
-                            Path.cwd().glob(
-                                f"**/*{video_filename}.{supported_type}")
-                        )
-                        if len(video_path) == 1:
-                            break
-
-                if len(video_path) == 0:
-                    # Sometimes the first word doesn't match (eg it is a phone number instead of a
-                    # contact name) so try again without the first word
-                    video_filename = "-".join(
-                        original_video_filename.split("-")[1:])
-                    video_path = list(Path.cwd().glob(
-                        f"**/*{video_filename}*"))
-
-                if len(video_path) == 0:
-                    # Sometimes the video filename matches the message filename instead of the
-                    # filename in the HTML. And sometimes the message filenames are repeated, eg
-                    # filefoo(0).html, filefoo(1).html, etc., but the video filename matches just
-                    # the base ("filefoo" in this example).
-                    video_filenames = [Path(file).stem, Path(
-                        file).stem.split("(")[0]]
-                    for video_filename in video_filenames:
-                        # Have to guess at the file extension in this case
-                        for supported_type in supported_types:
-                            video_path = list(
-                                Path.cwd().glob(
-                                    f"**/*{video_filename}*.{supported_type}"
-                                )
-                            )
-                            # Sometimes there's extra cruft in the filename in the HTML. So try to
-                            # match a subset of it.
-                            if len(video_path) > 1:
-                                for ip in video_path:
-                                    if ip.stem in original_video_filename:
-                                        video_path = [ip]
-                                        break
-
-                            if len(video_path) == 1:
-                                break
-                        if len(video_path) == 1:
-                            break
-
-                assert (
-                    len(video_path) != 0
-                ), f"No matching videos found. File name: {original_video_filename}"
-                assert (
-                    len(video_path) == 1
-                ), f"Multiple potential matching videos found. Videos: {[x for x in video_path]!r}"
-
-                video_path = video_path[0]
-                video_type = video_path.suffix[1:]
-                video_type = "3gpp" if video_type == "3pg" else video_type
-
-                with video_path.open("rb") as fb:
-                    video_bytes = fb.read()
-                byte_string = f"{b64encode(video_bytes)}"
-
-                video_parts += (
-                    f'    <part seq="0" ct="video/{video_type}" name="{video_path.name}" '
-                    f'chset="null" cd="null" fn="null" cid="&lt;{video_path.name}&gt;" '
-                    f'cl="{video_path.name}" ctt_s="null" ctt_t="null" text="null" '
-                    f'data="{byte_string[2:-1]}" />\n'
-                )
-
-        # Handle audios
-        audios = message.find_all("audio")
-        audio_parts = ""
-        if audios:
-            for audio in audios:
-                supported_types = ["mp3", "amr"]
-                audio_filename = audio["src"]
-                original_audio_filename = audio_filename
-                # Each audio found should only match a single file
-                audio_path = list(Path.cwd().glob(f"**/*{audio_filename}"))
-
-                if len(audio_path) == 0:
-                    # Sometimes they just forget the extension
-                    for supported_type in supported_types:
-                        audio_path = list(
-                            Path.cwd().glob(
-                                f"**/*{audio_filename}.{supported_type}")
-                        )
-                        if len(audio_path) == 1:
-                            break
-
-                if len(audio_path) == 0:
-                    # Sometimes the first word doesn't match (eg it is a phone number instead of a
-                    # contact name) so try again without the first word
-                    audio_filename = "-".join(
-                        original_audio_filename.split("-")[1:])
-                    audio_path = list(Path.cwd().glob(
-                        f"**/*{audio_filename}*"))
-
-                if len(audio_path) == 0:
-                    # Sometimes the audio filename matches the message filename instead of the
-                    # filename in the HTML. And sometimes the message filenames are repeated, eg
-                    # filefoo(0).html, filefoo(1).html, etc., but the audio filename matches just
-                    # the base ("filefoo" in this example).
-                    audio_filenames = [Path(file).stem, Path(
-                        file).stem.split("(")[0]]
-                    for audio_filename in audio_filenames:
-                        # Have to guess at the file extension in this case
-                        for supported_type in supported_types:
-                            audio_path = list(
-                                Path.cwd().glob(
-                                    f"**/*{audio_filename}*.{supported_type}"
-                                )
-                            )
-                            # Sometimes there's extra cruft in the filename in the HTML. So try to
-                            # match a subset of it.
-                            if len(audio_path) > 1:
-                                for ip in audio_path:
-                                    if ip.stem in original_audio_filename:
-                                        audio_path = [ip]
-                                        break
-
-                            if len(audio_path) == 1:
-                                break
-                        if len(audio_path) == 1:
-                            break
-
-                assert (
-                    len(audio_path) != 0
-                ), f"No matching audios found. File name: {original_audio_filename}"
-                assert (
-                    len(audio_path) == 1
-                ), f"Multiple potential matching audios found. Audios: {[x for x in audio_path]!r}"
-
-                audio_path = audio_path[0]
-                audio_type = audio_path.suffix[1:]
-                audio_type = "mpeg" if audio_type == "mp3" else audio_type
-
-                with audio_path.open("rb") as fb:
-                    audio_bytes = fb.read()
-                byte_string = f"{b64encode(audio_bytes)}"
-
-                audio_parts += (
-                    f'    <part seq="0" ct="audio/{audio_type}" name="{audio_path.name}" '
-                    f'chset="null" cd="null" fn="null" cid="&lt;{audio_path.name}&gt;" '
-                    f'cl="{audio_path.name}" ctt_s="null" ctt_t="null" text="null" '
-                    f'data="{byte_string[2:-1]}" />\n'
-                )
-
-        message_text = get_message_text(message)
-        time = get_message_time_unix(message)
-        participants_xml = ""
-        msg_box = 2 if sent_by_me else 1
-        m_type = 128 if sent_by_me else 132
-        for participant in participants:
-            participant_is_sender = participant == sender or (
-                sent_by_me and participant == "Me"
-            )
-            participant_values = {
-                "number": participant,
-                "code": 137 if participant_is_sender else 151,
-            }
-            participants_xml += (
-                '    <addr address="%(number)s" charset="106" type="%(code)s"/> \n'
-                % participant_values
-            )
-
-        mms_text = (
-            f'<mms address="{participants_text}" ct_t="application/vnd.wap.multipart.related" '
-            f'date="{time}" m_type="{m_type}" msg_box="{msg_box}" read="1" '
-            'rr="129" seen="1" sub_id="-1" text_only="1"> \n'
-            "  <parts> \n"
-            f'    <part ct="text/plain" seq="0" text="{message_text}"/> \n'
-            + image_parts
-            + video_parts
-            + audio_parts
-            + "  </parts> \n"
-            "  <addrs> \n"
-            f"{participants_xml}"
-            "  </addrs> \n"
-            "</mms> \n"
-        )
-
-        sms_backup_file.write(mms_text)
-
-    sms_backup_file.close()
-
-
-def get_message_type(message):  # author_raw = messages_raw[i].cite
-    author_raw = message.cite
-    if not author_raw:
-        return 1  # Someone else
-
-    if not author_raw.span:
-        return 2  # Me
-    else:
-        return 1  # Someone else
-
-
-def get_message_text(message):
-    return escape(str(message.find("q")).strip()[3:-4])
-
-
-def get_call_log_text(message):
-    return escape(message.find(class_="fn").text)
-
-
-def get_message_time_unix(message):
-    time_raw = message.find(class_="dt")
-    if not time_raw:
-        # Try call log format
-        time_raw = message.find(class_="published")
-
-    ymdhms = time_raw["title"]
-    time_obj = dateutil.parser.isoparse(ymdhms)
-    mstime = time.mktime(time_obj.timetuple()) * 1000
-    return int(mstime)
-
-
-def get_mms_sender(message, participants):
-    if message.cite:
-        sender = message.cite
-    else:
-        sender = message.find(class_="contributor")
-
-    number_text = sender.a["href"][4:]
-
-    if number_text != "":
-        number = format_number(phonenumbers.parse(number_text, None))
-    else:
-        assert (
-            len(participants) == 1
-        ), "Unable to determine sender in mms with multiple participants"
-        number = participants[0]
-    return number
-
-
-def get_first_phone_number(messages, fallback_number):
-    # handle group messages
-    for author_raw in messages:
-        if not author_raw:
-            continue
-
-        contributor = author_raw.find(class_="contributor")
-        if contributor:
-            sender_data = contributor
-        elif author_raw.span:
-            sender_data = author_raw.cite
-
-            # Skip if first number is Me
-            if sender_data.text == "Me":
-                continue
-        else:
-            continue
-
-        phonenumber_text = sender_data.a["href"][4:]
-
-        # Sometimes the first entry is missing a phone number
-        if phonenumber_text == "":
-            continue
-
-        try:
-            phone_number = phonenumbers.parse(phonenumber_text, None)
-        except phonenumbers.phonenumberutil.NumberParseException:
-            return phonenumber_text, sender_data
-
-        # sender_data can be used as participant for mms
-        return format_number(phone_number), sender_data
-
-    # fallback case, use number from filename
-    if fallback_number != 0 and len(fallback_number) >= 7:
-        fallback_number = format_number(
-            phonenumbers.parse(fallback_number, None))
-    # Create dummy participant
-    sender_data = BeautifulSoup(
-        f'<cite class="sender vcard"><a class="tel" href="tel:{fallback_number}"><abbr class="fn" '
-        'title="">Foo</abbr></a></cite>',
-        features="html.parser",
-    )
-    return fallback_number, sender_data
-
-
-def get_participant_phone_numbers(participants_raw):
-    participants = []
-
-    for participant_set in participants_raw:
-        for participant in participant_set:
-            if not hasattr(participant, "a"):
-                continue
-
-            phone_number_text = participant.a["href"][4:]
-            if phone_number_text == "" or phone_number_text == "0":
-                phone_number_text = " +00000000000"
-
-            try:
-                participants.append(
-                    format_number(phonenumbers.parse(phone_number_text, None))
-                )
-            except phonenumbers.phonenumberutil.NumberParseException:
-                participants.append(phone_number_text)
-
-    return participants
-
-
-def write_header(filename, numsms):
-    # Prepend header in memory efficient manner since the output file can be huge
-    with NamedTemporaryFile(dir=Path.cwd(), delete=False) as backup_temp:
-        backup_temp.write(
-            b"<?xml version='1.0' encoding='UTF-8' standalone='yes' ?>\n")
-        backup_temp.write(b"<!--Converted from GV Takeout data -->\n")
-        backup_temp.write(
-            bytes(f'<smses count="{str(numsms)}">\n', encoding="utf8"))
-        with open(filename, "rb") as backup_file:
-            copyfileobj(backup_file, backup_temp)
-    # Overwrite output file with temp file
-    move(backup_temp.name, filename)
-
-
-def format_number(phone_number):
-    return phonenumbers.format_number(phone_number, phonenumbers.PhoneNumberFormat.E164)
-
-
-def escape(message):
-    return message.replace("<br/>", "&#10;").replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace("\"", "&quot;").replace("'", "&apos;")
-
-
-main()
+import argparse
+import gzip
+import hashlib
+import heapq
+import inspect
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+import zlib
+from base64 import b64encode
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from fnmatch import fnmatch
+from functools import lru_cache, partial
+from html import unescape
+from html.parser import HTMLParser
+from io import BytesIO, TextIOWrapper, open  # adds emoji support
+from multiprocessing import Pool
+from pathlib import Path, PurePosixPath
+from queue import Queue
+from shutil import copyfileobj, move
+from struct import Struct
+from tempfile import TemporaryDirectory
+from threading import Lock, Thread, get_ident
+from zipfile import ZipFile, is_zipfile
+
+# bs4, phonenumbers and dateutil are slow to import, so they are only imported where they are used.
+# Importing this script for read_messages stays quick, and eg call logs never need bs4.
+
+output_filename = "./gvoice-all.xml"
+# The numbered output files with --split-size or --split-count
+split_output_filename = "./gvoice-{:04d}.xml"
+manifest_filename = output_filename + ".manifest"
+
+# The output files of this run, which main() gives eg a .gz suffix with --compress
+sms_backup_filename = output_filename
+split_backup_filename = split_output_filename
+
+# Number of .html files each worker converts into a single shard in --jobs mode
+files_per_shard = 50
+
+# Output file buffer size. --write-buffer
+write_buffer_size = 1024 * 1024
+
+# Write the output file on a separate thread. --background-writer
+background_writer = False
+
+# Chunks of output waiting for the background writer thread before converting has to wait
+write_queue_size = 64
+
+# Folder with the Takeout files in it, as used by read_messages. The script uses the current
+# directory
+takeout_root = "."
+
+# Takeout .zip archives to read instead of takeout_root. --zip
+takeout_zips = []
+
+# Bytes of an attachment read and base64 encoded at a time. Must be a multiple of 3.
+part_chunk_size = 3 * 256 * 1024
+
+# Start a new output file after this many bytes or messages. --split-size and --split-count
+split_size = None
+split_count = None
+
+# Compress the output as it is written, "gzip" or "zstd". --compress and --compress-level
+output_compression = None
+compression_level = None
+compressed_suffixes = {"gzip": ".gz", "zstd": ".zst"}
+
+# Write the messages sorted by date, with an external merge sort. --sort-by-date
+sort_by_date = False
+
+# Messages indexed in memory before a sorted run is saved to disk, and how many runs are merged
+# at once
+sort_run_length = 100000
+sort_merge_width = 256
+
+# Drop messages already written, eg where several overlapping Takeout exports are converted
+# together. --dedup and --dedup-index
+dedup = False
+
+# Memory SQLite may use for pages of the --dedup index
+dedup_cache_size = 64 * 1024 * 1024
+
+# Attachment digests remembered for the --dedup keys
+digest_cache_size = 4096
+
+# Also save every message converted in an SQLite store, for writing the output again later
+# without parsing the .html files. --store and --from-store
+store_messages = False
+
+# Bytes of base64 encoded attachments kept in memory to copy in again when the same file is
+# attached more than once. --attachment-cache
+attachment_cache_size = 64 * 1024 * 1024
+
+# Directory for encoded attachments too big for attachment_cache_size. --attachment-spill
+attachment_spill_dir = None
+
+# Read the .html files coming up, and their attachments, on background threads while converting,
+# this many files ahead. 0 turns it off. --prefetch
+prefetch_depth = 0
+
+# Bytes read ahead that haven't been used yet, at most. --prefetch-memory
+prefetch_budget = 64 * 1024 * 1024
+
+# Threads reading ahead
+prefetch_threads = 4
+
+# Digits reserved for the message count in the <smses count="..."> header
+header_count_width = 20
+
+# Distinct phone numbers remembered by parse_number
+number_cache_size = 4096
+
+# Distinct hours remembered by get_hour_start_unix
+hour_cache_size = 65536
+
+
+def main(argv=None):
+    """Run the script with the options in argv (default: the command line)
+
+    Everything a run changes is put back afterwards, so it can be called more than once, eg from
+    Python with different options.
+    """
+    global attachment_cache, file_index, zip_members
+    saved_globals = {name: globals()[name] for name in run_globals}
+    try:
+        run(argv)
+    finally:
+        if run_stats:
+            run_stats.uninstall()
+        globals().update(saved_globals)
+        # Made for this run's input and settings
+        attachment_cache = file_index = zip_members = None
+        fallback_phone_numbers.clear()
+        fallback_files.clear()
+        message_keys.clear()
+
+
+# The globals run() sets, which main() puts back once it is done
+run_globals = [
+    "html_parser",
+    "write_buffer_size",
+    "background_writer",
+    "takeout_zips",
+    "attachment_cache_size",
+    "attachment_spill_dir",
+    "prefetch_depth",
+    "prefetch_budget",
+    "split_size",
+    "split_count",
+    "output_compression",
+    "compression_level",
+    "sms_backup_filename",
+    "split_backup_filename",
+    "sort_by_date",
+    "dedup",
+    "dedup_index",
+    "store_messages",
+    "message_store",
+    "run_stats",
+    "print_file_names",
+]
+
+
+def run(argv):
+    global html_parser, write_buffer_size, background_writer, takeout_zips
+    global attachment_cache_size, attachment_spill_dir, split_size, split_count
+    global output_compression, compression_level, sms_backup_filename, split_backup_filename
+    global run_stats, print_file_names, sort_by_date, dedup, dedup_index
+    global store_messages, message_store, prefetch_depth, prefetch_budget
+
+    parser = argparse.ArgumentParser(
+        description="Convert Google Voice Takeout data to SMS Backup and Restore XML"
+    )
+    parser.add_argument(
+        "--zip",
+        action="append",
+        default=[],
+        metavar="TAKEOUT_ZIP",
+        help="read the Takeout .zip archive directly instead of the extracted files in this "
+        "directory. Give it once for each archive if the export was split into several",
+    )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        default=[],
+        choices=file_categories,
+        help="skip one kind of file, going by the Takeout file names, eg --exclude placed "
+        "--exclude received --exclude missed to leave out the call history. Can be given more "
+        "than once",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of worker processes used to convert the .html files (default: 1)",
+    )
+    parser.add_argument(
+        "--parser",
+        choices=sorted(html_parsers),
+        default=html_parser,
+        help="how to parse the .html files. lxml is several times faster but needs the lxml "
+        "package (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--count-first",
+        action="store_true",
+        help="count the messages before converting so the header is written up front, instead of "
+        "being filled in at the end",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue an interrupted run where it stopped, using the list of converted files "
+        f"kept in {manifest_filename}",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="append",
+        default=[],
+        metavar="MANIFEST",
+        help="only convert files that aren't listed with the same size in MANIFEST from an "
+        "earlier run, eg to convert just what a newer Takeout export added. Can be given more "
+        "than once",
+    )
+    parser.add_argument(
+        "--write-buffer",
+        type=int,
+        default=write_buffer_size // 1024 // 1024,
+        metavar="MB",
+        help="size of the output file buffer in MB (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--background-writer",
+        action="store_true",
+        help="write the output file from a separate thread, so converting and writing overlap",
+    )
+    parser.add_argument(
+        "--split-size",
+        type=int,
+        metavar="MB",
+        help="split the output over gvoice-0001.xml, gvoice-0002.xml, ... starting a new file "
+        "once one reaches MB. Messages are never split between files",
+    )
+    parser.add_argument(
+        "--split-count",
+        type=int,
+        metavar="N",
+        help="split the output over gvoice-0001.xml, gvoice-0002.xml, ... with N messages in "
+        "each file",
+    )
+    parser.add_argument(
+        "--compress",
+        choices=compressed_suffixes,
+        help="compress the output as it is written, into gvoice-all.xml.gz or gvoice-all.xml.zst. "
+        "zstd needs the zstandard package (python -m pip install zstandard)",
+    )
+    parser.add_argument(
+        "--compress-level",
+        type=int,
+        metavar="LEVEL",
+        help="compression level, 0-9 for gzip (default 6) or 1-22 for zstd (default 3)",
+    )
+    parser.add_argument(
+        "--sort-by-date",
+        action="store_true",
+        help="write the messages from every conversation in date order, instead of file by file. "
+        "Needs temporary disk space about the size of the uncompressed output",
+    )
+    parser.add_argument(
+        "--sort-dir",
+        metavar="DIR",
+        default=".",
+        help="where --sort-by-date keeps its temporary files (default: this directory)",
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="drop messages that were already written, going by their addresses, date, type, text "
+        "and attachments, eg when converting several overlapping Takeout exports at once",
+    )
+    parser.add_argument(
+        "--dedup-index",
+        metavar="FILE",
+        help="keep the --dedup index in FILE, so later runs also drop the messages written by "
+        "earlier ones. Implies --dedup",
+    )
+    parser.add_argument(
+        "--store",
+        metavar="FILE",
+        help="also save every message converted in the SQLite database FILE, so the output can be "
+        "written again with --from-store without parsing the .html files",
+    )
+    parser.add_argument(
+        "--from-store",
+        metavar="FILE",
+        help="write the output from the messages saved with --store instead of converting the "
+        ".html files. Attachments are still read from the Takeout files, so run it from the same "
+        "directory with the same --zip options",
+    )
+    parser.add_argument(
+        "--after",
+        metavar="DATE",
+        help="with --from-store, only write messages from DATE on, eg 2020-01-31 or "
+        "2020-01-31T18:00. Like the message times, the clock time counts and any offset is "
+        "ignored",
+    )
+    parser.add_argument(
+        "--before", metavar="DATE", help="with --from-store, only write messages before DATE"
+    )
+    parser.add_argument(
+        "--contact",
+        action="append",
+        default=[],
+        metavar="NUMBER",
+        help="with --from-store, only write messages to or from NUMBER, including group messages "
+        "they are in. Can be given more than once",
+    )
+    parser.add_argument(
+        "--attachment-cache",
+        type=int,
+        default=attachment_cache_size // 1024 // 1024,
+        metavar="MB",
+        help="memory for keeping encoded attachments, so a file attached to several messages is "
+        "only read and encoded once. 0 turns it off (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--attachment-spill",
+        metavar="DIR",
+        help="keep encoded attachments too big for --attachment-cache in temporary files in DIR",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=prefetch_depth,
+        metavar="N",
+        help="read the next N .html files and their attachments on background threads while "
+        "converting, so reading overlaps with parsing and encoding. Helps most on network drives "
+        "and hard disks. 0 turns it off (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--prefetch-memory",
+        type=int,
+        default=prefetch_budget // 1024 // 1024,
+        metavar="MB",
+        help="memory for the files read ahead by --prefetch. With --jobs, each worker has this "
+        "much (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="show a progress line instead of every file name, then the time spent in each stage "
+        "and other counters. With --jobs, only the main process's time is broken down",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="FILE",
+        help="run under cProfile, save the pstats to FILE and print the top functions",
+    )
+    args = parser.parse_args(argv)
+
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.write_buffer < 1:
+        parser.error("--write-buffer must be at least 1 MB")
+    write_buffer_size = args.write_buffer * 1024 * 1024
+    if args.split_size is not None and args.split_size < 1:
+        parser.error("--split-size must be at least 1 MB")
+    if args.split_count is not None and args.split_count < 1:
+        parser.error("--split-count must be at least 1")
+    split_size = args.split_size and args.split_size * 1024 * 1024
+    split_count = args.split_count
+    splitting = bool(split_size or split_count)
+    if splitting and (args.resume or args.count_first):
+        parser.error("--resume and --count-first only work with a single output file")
+    output_compression = args.compress
+    if args.compress_level is not None and not output_compression:
+        parser.error("--compress-level only works with --compress")
+    compression_level = args.compress_level
+    if output_compression:
+        if args.resume:
+            parser.error("--resume doesn't work with --compress")
+        min_level, max_level = (0, 9) if output_compression == "gzip" else (1, 22)
+        if compression_level is not None and not min_level <= compression_level <= max_level:
+            parser.error(
+                f"--compress-level for {output_compression} must be {min_level}-{max_level}"
+            )
+        if output_compression == "zstd":
+            try:
+                import zstandard  # noqa: F401
+            except ImportError:
+                parser.error(
+                    "--compress zstd needs the zstandard package (python -m pip install zstandard)"
+                )
+        sms_backup_filename = output_filename + compressed_suffixes[output_compression]
+        split_backup_filename = split_output_filename + compressed_suffixes[output_compression]
+    sort_by_date = args.sort_by_date
+    if sort_by_date and args.resume:
+        parser.error("--resume doesn't work with --sort-by-date")
+    dedup = bool(args.dedup or args.dedup_index)
+    if dedup and (args.resume or args.count_first):
+        parser.error("--resume and --count-first don't work with --dedup")
+    if args.store and args.from_store:
+        parser.error("--store and --from-store can't be used together")
+    if args.store and args.resume:
+        parser.error("--resume doesn't work with --store")
+    if args.from_store:
+        if args.resume or args.count_first or args.incremental or args.exclude:
+            parser.error(
+                "--resume, --count-first, --incremental and --exclude don't work with --from-store"
+            )
+        if not os.path.exists(args.from_store):
+            parser.error(f"{args.from_store} doesn't exist")
+    elif args.after or args.before or args.contact:
+        parser.error("--after, --before and --contact only work with --from-store")
+    after = args.after and parse_date_option(parser, "--after", args.after)
+    before = args.before and parse_date_option(parser, "--before", args.before)
+    if args.attachment_cache < 0:
+        parser.error("--attachment-cache can't be negative")
+    attachment_cache_size = args.attachment_cache * 1024 * 1024
+    if args.prefetch < 0:
+        parser.error("--prefetch can't be negative")
+    if args.prefetch_memory < 1:
+        parser.error("--prefetch-memory must be at least 1 MB")
+    prefetch_depth = args.prefetch
+    prefetch_budget = args.prefetch_memory * 1024 * 1024
+    for zip_filename in args.zip:
+        if not os.path.exists(zip_filename):
+            parser.error(f"{zip_filename} doesn't exist")
+        if not is_zipfile(zip_filename):
+            parser.error(f"{zip_filename} isn't a .zip archive")
+    for incremental_manifest in args.incremental:
+        if not os.path.exists(incremental_manifest):
+            parser.error(f"{incremental_manifest} doesn't exist")
+    takeout_zips = args.zip
+    background_writer = args.background_writer
+    html_parser = args.parser
+    if html_parser == "lxml":
+        try:
+            import lxml.html  # noqa: F401
+        except ImportError:
+            parser.error("--parser lxml needs the lxml package (python -m pip install lxml)")
+
+    profiler = None
+    if args.profile:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if args.stats:
+        run_stats = RunStats()
+        run_stats.install()
+        print_file_names = False
+
+    if splitting:
+        print("New files will be saved to " + split_backup_filename.format(1) + " onwards")
+    else:
+        print("New file will be saved to " + sms_backup_filename)
+
+    stored_messages = None
+    if args.from_store:
+        print("Writing the messages saved in " + args.from_store)
+        contacts = [get_contact_number(contact) for contact in args.contact]
+        stored_messages = read_stored_messages(args.from_store, after, before, contacts)
+        sms_filenames = []
+    elif takeout_zips:
+        print("Checking " + ", ".join(takeout_zips) + " for Voice/Calls/*.html files")
+        sms_filenames = get_sms_filenames(takeout_root)
+    else:
+        print("Checking directory for *.html files")
+        sms_filenames = get_sms_filenames(takeout_root)
+
+    if args.exclude:
+        sms_filenames = [
+            (sms_filename, file)
+            for sms_filename, file in sms_filenames
+            if get_file_category(file) not in args.exclude
+        ]
+        print(f"Skipping {', '.join(args.exclude)} files")
+
+    earlier_entries = []
+    if args.incremental:
+        converted_before = read_converted_files(args.incremental)
+        earlier_entries = list(converted_before.values())
+        sms_filenames = [
+            (sms_filename, file)
+            for sms_filename, file in sms_filenames
+            if (file, get_input_stat(sms_filename)[0]) not in converted_before
+        ]
+        print(f"{len(sms_filenames)} new or changed files to convert")
+
+    resume_point = None
+    if args.resume:
+        resume_point = get_resume_point()
+        if resume_point is None:
+            print("Nothing to resume, starting from the beginning")
+
+    if resume_point is not None:
+        manifest_settings, manifest_entries = resume_point
+        count_first = manifest_settings["count_first"]
+        converted = {entry["path"] for entry in manifest_entries}
+        sms_filenames = [
+            (sms_filename, file)
+            for sms_filename, file in sms_filenames
+            if sms_filename not in converted
+        ]
+        num_files_done = sum(1 for entry in manifest_entries if not entry.get("earlier"))
+        print(f"Resuming after {num_files_done} converted files")
+
+        # Throw away anything written after the last file that was completely converted
+        offset = (manifest_entries or [manifest_settings])[-1]["offset"]
+        with open(sms_backup_filename, "r+b") as sms_backup_file:
+            sms_backup_file.truncate(offset)
+        num_sms_done = sum(entry["count"] for entry in manifest_entries)
+    else:
+        count_first = args.count_first
+        num_sms_counted = None
+        if count_first:
+            print("Counting messages")
+            num_sms_counted = sum(
+                count_messages(sms_filename) for sms_filename, file in sms_filenames
+            )
+
+        if splitting:
+            # Each of the split files gets its own header
+            offset = 0
+        else:
+            # Clear file if it already exists
+            with open(sms_backup_filename, "wb") as sms_backup_file:
+                if num_sms_counted is None:
+                    # Leave room for the count, it gets filled in by write_header at the end
+                    sms_backup_file.write(get_header(0, reserve=True))
+                else:
+                    sms_backup_file.write(get_header(num_sms_counted))
+                offset = sms_backup_file.tell()
+
+        manifest_settings = {
+            "output": get_output_mode(splitting),
+            "count_first": count_first,
+            "num_sms_counted": num_sms_counted,
+            "offset": offset,
+        }
+        # The files converted by the runs before an --incremental one are listed first, with
+        # nothing written for them, so the next --incremental run can go by this manifest alone
+        manifest_entries = [
+            dict(entry, count=0, offset=offset, earlier=True) for entry in earlier_entries
+        ]
+        num_sms_done = 0
+
+    spill_dir = None
+    if args.attachment_spill:
+        spill_dir = TemporaryDirectory(dir=args.attachment_spill)
+        attachment_spill_dir = spill_dir.name
+
+    dedup_dir = None
+    if args.dedup_index:
+        dedup_index = DedupIndex(args.dedup_index)
+    elif dedup:
+        dedup_dir = TemporaryDirectory()
+        dedup_index = DedupIndex(os.path.join(dedup_dir.name, "keys.db"), temporary=True)
+
+    if args.store:
+        store_messages = True
+        message_store = MessageStore(args.store)
+
+    if splitting:
+        backup_writer = SplitWriter(split_backup_filename)
+    else:
+        backup_writer = BackupWriter(sms_backup_filename)
+
+    if run_stats:
+        run_stats.total_files = len(sms_filenames)
+
+    with Manifest(
+        manifest_settings, manifest_entries
+    ) as manifest, backup_writer as sms_backup_file:
+        if sort_by_date:
+            with TemporaryDirectory(dir=args.sort_dir, prefix=".gvoice-sort-") as sort_dir:
+                with SortingWriter(os.path.join(sort_dir, "messages.xml"), sort_dir) as sort_file:
+                    num_sms = convert_all_files(
+                        sort_file, sms_filenames, args.jobs, manifest, stored_messages
+                    )
+                    print("Writing the messages sorted by date")
+                    sort_file.write_sorted(sms_backup_file)
+        else:
+            num_sms = convert_all_files(
+                sms_backup_file, sms_filenames, args.jobs, manifest, stored_messages
+            )
+
+        if not splitting:
+            sms_backup_file.write("</smses>")
+
+    if spill_dir is not None:
+        spill_dir.cleanup()
+    if message_store is not None:
+        message_store.close()
+        print(f"Saved {message_store.num_messages} messages in {args.store}")
+    if dedup_index is not None:
+        # Only now that the output is complete are its keys kept for later runs
+        dedup_index.close()
+        print(f"Dropped {dedup_index.duplicates} duplicate messages")
+        if dedup_dir is not None:
+            dedup_dir.cleanup()
+    attachment_cache = get_attachment_cache()
+    if attachment_cache is not None and attachment_cache.reused:
+        print(
+            f"Reused {attachment_cache.reused} encoded attachments, "
+            f"{attachment_cache.bytes_saved / 1024 / 1024:.1f} MB not read and encoded again"
+        )
+
+    num_sms += num_sms_done
+    num_sms_counted = manifest_settings["num_sms_counted"]
+    if splitting:
+        num_files = len(backup_writer.filenames)
+        print(f"Saved {num_sms} messages in {num_files} files")
+        # Clear files left over from an earlier run that was split into more
+        while os.path.exists(split_backup_filename.format(num_files + 1)):
+            os.remove(split_backup_filename.format(num_files + 1))
+            num_files += 1
+    elif not count_first:
+        write_header(sms_backup_filename, num_sms)
+    elif num_sms_counted != num_sms:
+        print(
+            f"Warning: counted {num_sms_counted} messages up front but converted {num_sms}. "
+            "The count in the header is wrong."
+        )
+
+    if run_stats:
+        run_stats.report()
+    if profiler is not None:
+        import pstats
+
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        print(f"Profile saved to {args.profile}")
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+
+
+class Manifest:
+    """Record of every file converted so far, kept next to the output file.
+
+    The first line of the file holds the settings the output was started with, including the
+    offset just after the header. Each following line is one converted .html file: its path, size
+    and modification time, how many messages it had and the output file offset just after them.
+    After an --incremental run, the files converted by the runs before it come first, marked
+    earlier, with a count of 0 and the offset after the header. Each line is flushed as soon as
+    it is written, but the output file is buffered, so an entry can be ahead of the output;
+    get_resume_point checks the output size to sort that out.
+    """
+
+    def __init__(self, settings, entries=()):
+        self.file = open(manifest_filename, "w", encoding="utf8")
+        self._write(settings)
+        for entry in entries:
+            self._write(entry)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file.close()
+
+    def record(self, sms_filename, num_sms, offset):
+        size, mtime = get_input_stat(sms_filename)
+        self._write(
+            {
+                "path": sms_filename,
+                "size": size,
+                "mtime": mtime,
+                "count": num_sms,
+                "offset": offset,
+            }
+        )
+
+    def _write(self, entry):
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+
+
+def read_manifest(filename):
+    lines = []
+    with open(filename, "r", encoding="utf8") as manifest_file:
+        for line in manifest_file:
+            try:
+                lines.append(json.loads(line))
+            except ValueError:
+                # The last line can be cut short if the run was killed while writing it
+                break
+    return lines[0], lines[1:]
+
+
+def get_resume_point():
+    if not os.path.exists(manifest_filename) or not os.path.exists(sms_backup_filename):
+        return None
+
+    settings, entries = read_manifest(manifest_filename)
+    # The offsets of a split, compressed or sorted run don't point into gvoice-all.xml. Older
+    # manifests didn't record the mode, so those could be from any of them too.
+    if settings.get("output") != "single":
+        return None
+    backup_size = os.path.getsize(sms_backup_filename)
+    if backup_size < settings["offset"]:
+        return None
+
+    # Keep the files whose messages made it into the output and haven't changed since
+    resume_entries = []
+    for entry in entries:
+        if entry.get("earlier"):
+            # Converted by an earlier run, and may not even be in this Takeout folder
+            resume_entries.append(entry)
+            continue
+        if entry["offset"] > backup_size or get_manifest_key(entry) != get_file_key(entry["path"]):
+            break
+        resume_entries.append(entry)
+    return settings, resume_entries
+
+
+def get_output_mode(splitting):
+    """How the output is being written, for the manifest. Only "single" can be resumed."""
+    if splitting:
+        return "split"
+    if output_compression:
+        return output_compression
+    if sort_by_date:
+        return "sorted"
+    if dedup:
+        # A --resume without --dedup would write the duplicates
+        return "dedup"
+    return "single"
+
+
+def read_converted_files(manifest_filenames):
+    # A newer export has new paths and modification times, so go by the file name and size. The
+    # manifest entries are kept, to be listed in this run's manifest too.
+    converted = {}
+    for filename in manifest_filenames:
+        settings, entries = read_manifest(filename)
+        for entry in entries:
+            converted.setdefault((os.path.basename(entry["path"]), entry["size"]), entry)
+    return converted
+
+
+def get_file_key(sms_filename):
+    try:
+        return (sms_filename,) + get_input_stat(sms_filename)
+    except (OSError, KeyError):
+        return None
+
+
+def get_manifest_key(entry):
+    return entry["path"], entry["size"], entry["mtime"]
+
+
+def get_sms_filenames(root_dir):
+    if takeout_zips:
+        return [
+            (sms_filename, member.name)
+            for sms_filename, member in get_zip_members().items()
+            if takeout_zip_html.search(member.info.filename)
+        ]
+
+    sms_filenames = []
+    for subdir, dirs, files in os.walk(root_dir):
+        for file in files:
+            sms_filename = os.path.join(subdir, file)
+
+            if os.path.splitext(sms_filename)[1] != ".html":
+                # print(sms_filename,"- skipped")
+                continue
+
+            sms_filenames.append((sms_filename, file))
+
+    return sms_filenames
+
+
+# The conversations and call logs inside a Takeout archive
+takeout_zip_html = re.compile(r"(^|/)Voice/Calls/[^/]+\.html$")
+
+
+def convert_all_files(sms_backup_file, sms_filenames, jobs, manifest, messages=None):
+    # messages, eg from read_stored_messages, are written instead of converting any files
+    if messages is not None:
+        return write_messages(sms_backup_file, messages)
+    if jobs > 1:
+        return convert_files_parallel(sms_backup_file, sms_filenames, jobs, manifest)
+    return convert_files(sms_backup_file, sms_filenames, manifest)
+
+
+def convert_files(sms_backup_file, sms_filenames, manifest=None):
+    num_sms = 0
+    for sms_filename, file in prefetch_files(sms_filenames):
+        num_sms_file = convert_file(sms_backup_file, sms_filename, file)
+        num_sms += num_sms_file
+        if manifest:
+            manifest.record(sms_filename, num_sms_file, sms_backup_file.position)
+        if run_stats:
+            run_stats.file_done(num_sms_file, sms_backup_file.position)
+    return num_sms
+
+
+def prefetch_files(sms_filenames):
+    """Go through sms_filenames, with a Prefetcher reading ahead if --prefetch is on"""
+    global prefetcher
+    if not prefetch_depth:
+        yield from sms_filenames
+        return
+    sms_filenames = list(sms_filenames)
+    prefetcher = Prefetcher(sms_filenames)
+    try:
+        for index, sms_file in enumerate(sms_filenames):
+            prefetcher.advance(index)
+            yield sms_file
+    finally:
+        if run_stats:
+            run_stats.files_read_ahead += prefetcher.files_used
+            run_stats.bytes_read_ahead += prefetcher.bytes_used
+        prefetcher.close()
+        prefetcher = None
+
+
+def convert_file(sms_backup_file, sms_filename, file):
+    if print_file_names:
+        print("Processing " + sms_filename)
+    # Counting what was written, which leaves out any --dedup drops
+    num_sms = 0
+    for message in read_file_messages(sms_filename, file):
+        num_sms += write_message(sms_backup_file, message)
+    return num_sms
+
+
+def read_file_messages(sms_filename, file):
+    """The MessageRecords in one of the .html files"""
+    is_group_conversation = get_file_category(file) == "group"
+
+    conversation = parse_takeout_file(get_input_path(sms_filename))
+
+    messages_raw = conversation.messages
+
+    # The whole path is passed on, so attachments can be looked for next to the file first
+    if len(messages_raw):
+        if is_group_conversation:
+            participants_raw = conversation.participants
+            yield from get_mms_messages(sms_filename, participants_raw, messages_raw)
+        else:
+            yield from get_sms_messages(sms_filename, messages_raw)
+
+    call_log_messages_raw = conversation.call_logs
+    if len(call_log_messages_raw):
+        yield from get_sms_messages(sms_filename, call_log_messages_raw)
+
+
+def read_messages(root=".", zips=()):
+    """Every message in a Takeout folder, as MessageRecords in the order the script writes them
+
+    For using the script as a library, eg
+
+        for message in sms.read_messages("Takeout"):
+            print(message.date, message.addresses, message.text)
+
+    With zips, the messages are read from those Takeout .zip archives instead. Each message can
+    be passed to write_message to write it out, eg to a SplitWriter, which makes complete files
+    with headers, or saved with MessageStore.add.
+    """
+    global takeout_root, takeout_zips, file_index, zip_members
+    takeout_root, takeout_zips = str(root), list(zips)
+    # Anything remembered about another folder doesn't apply
+    file_index = zip_members = None
+    fallback_phone_numbers.clear()
+    fallback_files.clear()
+    for sms_filename, file in get_sms_filenames(takeout_root):
+        yield from read_file_messages(sms_filename, file)
+
+
+# One message, as written out by write_message or saved in a MessageStore. kind is "sms" or
+# "mms". addresses is the one number for an SMS, or the participants of an MMS. date is in
+# milliseconds and type is 1 for received and 2 for sent (msg_box for an MMS). text is escaped for
+# the XML already. sender is only for an MMS, and parts are the (content type, path) of each of
+# its attachments. timestamp is the time as Takeout wrote it, which unlike date has the
+# milliseconds, so --dedup can tell apart messages sent in the same second.
+MessageRecord = namedtuple(
+    "MessageRecord",
+    ["kind", "addresses", "date", "type", "text", "sender", "parts", "timestamp"],
+    defaults=[None],
+)
+
+
+def convert_files_parallel(sms_backup_file, sms_filenames, jobs, manifest=None):
+    # Workers convert consecutive runs of files into shard files, which are appended to the output
+    # in their original order, so the result is identical to converting the files one at a time.
+    # The shards live outside the Takeout tree so they never turn up in attachment lookups.
+    num_sms = 0
+    with TemporaryDirectory() as shard_dir:
+        shards = [
+            (
+                os.path.join(shard_dir, f"shard-{i}.xml"),
+                sms_filenames[start:start + files_per_shard],
+                get_worker_settings(),
+            )
+            for i, start in enumerate(range(0, len(sms_filenames), files_per_shard))
+        ]
+
+        with Pool(jobs) as pool:
+            for (shard_filename, _, _), (converted, reused, shard_output) in zip(
+                shards, pool.imap(convert_shard, shards)
+            ):
+                if reused is not None:
+                    attachment_cache = get_attachment_cache()
+                    attachment_cache.reused += reused[0]
+                    attachment_cache.bytes_saved += reused[1]
+                offset = sms_backup_file.position
+                if dedup:
+                    converted = add_unique_messages(
+                        sms_backup_file, shard_filename, converted, *shard_output
+                    )
+                elif sort_by_date:
+                    sms_backup_file.add_shard(shard_filename, shard_output)
+                elif split_size or split_count:
+                    # The worker already split its shard, so its files only need moving in
+                    sms_backup_file.add_files(shard_output)
+                else:
+                    shard_size = converted[-1][2]
+                    sms_backup_file.write_file(
+                        shard_filename, remove=True, uncompressed_size=shard_size
+                    )
+                if message_store is not None:
+                    message_store.add_shard(get_shard_store_filename(shard_filename))
+                    os.remove(get_shard_store_filename(shard_filename))
+                for sms_filename, num_sms_file, shard_offset in converted:
+                    num_sms += num_sms_file
+                    if manifest:
+                        manifest.record(sms_filename, num_sms_file, offset + shard_offset)
+                    if run_stats:
+                        run_stats.file_done(num_sms_file, offset + shard_offset)
+
+            # Make sure every shard is copied before the directory goes away
+            sms_backup_file.flush()
+
+    return num_sms
+
+
+def convert_shard(shard):
+    # Runs in a worker process, which may have started from a fresh import of this script
+    shard_filename, sms_filenames, settings = shard
+    global message_store
+    # A forked worker has a copy of the main process's dedup_index, but only the main process
+    # checks the keys, as it adds the shards in order. The same goes for the message_store, which
+    # the shard gets its own of.
+    globals().update(settings, dedup_index=None, message_store=None)
+    message_keys.clear()
+    if store_messages:
+        message_store = MessageStore(get_shard_store_filename(shard_filename))
+    if sort_by_date or dedup:
+        # Sorting, splitting and dropping duplicates happen as the main process merges everything
+        backup_writer = SortingWriter(shard_filename)
+    elif split_size or split_count:
+        backup_writer = SplitWriter(shard_filename[: -len(".xml")] + "-{:04d}.xml")
+    else:
+        open(shard_filename, "w").close()
+        backup_writer = BackupWriter(shard_filename)
+    # The message count and shard offset after each file, for the manifest
+    converted = []
+    # The worker's attachment cache outlives the shard, so only report what this shard reused
+    attachment_cache = get_attachment_cache()
+    if attachment_cache is not None:
+        reused, bytes_saved = attachment_cache.reused, attachment_cache.bytes_saved
+    with backup_writer as sms_backup_file:
+        for sms_filename, file in prefetch_files(sms_filenames):
+            num_sms_file = convert_file(sms_backup_file, sms_filename, file)
+            converted.append((sms_filename, num_sms_file, sms_backup_file.position))
+    if message_store is not None:
+        message_store.close(indexed=False)
+    if attachment_cache is not None:
+        reused = (attachment_cache.reused - reused, attachment_cache.bytes_saved - bytes_saved)
+    else:
+        reused = None
+    # What the main process needs, other than the shard file, to add the shard to the output
+    if dedup:
+        shard_output = backup_writer.entries, message_keys
+    elif sort_by_date:
+        shard_output = backup_writer.entries
+    elif split_size or split_count:
+        shard_output = backup_writer.filenames
+    else:
+        shard_output = None
+    return converted, reused, shard_output
+
+
+def add_unique_messages(sms_backup_file, shard_filename, converted, entries, keys):
+    """Copy the messages in a worker's shard that aren't duplicates to the output
+
+    The shard was written by a SortingWriter, and keys are its messages' --dedup keys. Returns
+    converted with the counts and shard offsets changed to what was copied.
+    """
+    start = sms_backup_file.position
+    unique_converted = []
+    messages = zip(entries, keys)
+    message = next(messages, None)
+    with open(shard_filename, "rb") as shard_file:
+        for sms_filename, num_sms_file, shard_offset in converted:
+            num_sms_file = 0
+            # The file's messages are the ones starting before the offset after it
+            while message is not None and message[0][1] < shard_offset:
+                (date, offset, length), key = message
+                if dedup_index.add(key):
+                    copy_message(shard_file, offset, length, sms_backup_file)
+                    sms_backup_file.end_message(date)
+                    num_sms_file += 1
+                message = next(messages, None)
+            unique_converted.append(
+                (sms_filename, num_sms_file, sms_backup_file.position - start)
+            )
+    os.remove(shard_filename)
+    return unique_converted
+
+
+def get_shard_store_filename(shard_filename):
+    return shard_filename[: -len(".xml")] + ".db"
+
+
+def get_worker_settings():
+    return {name: globals()[name] for name in worker_settings}
+
+
+# Settings main() chooses that worker processes need too
+worker_settings = [
+    "html_parser",
+    "write_buffer_size",
+    "background_writer",
+    "takeout_root",
+    "takeout_zips",
+    "attachment_cache_size",
+    "attachment_spill_dir",
+    "prefetch_depth",
+    "prefetch_budget",
+    "split_size",
+    "split_count",
+    "output_compression",
+    "compression_level",
+    "print_file_names",
+    "sort_by_date",
+    "dedup",
+    "store_messages",
+]
+
+
+class RunStats:
+    """Timers, counters and the progress line for --stats
+
+    Times the functions in stats_functions, or the ones given by stage in functions (as
+    bench/run_benchmark.py does), by wrapping them, so nothing is timed without --stats. When a
+    timed function calls another, the time counts toward the inner one only.
+    """
+
+    def __init__(self, functions=None):
+        self.functions = functions or stats_functions
+        self.start = time.perf_counter()
+        self.seconds = {}
+        self.calls = {}
+        # The functions install replaced, with what they belong to
+        self.installed = []
+        # The timed functions currently running, innermost last, and when the innermost one
+        # last resumed
+        self.running = []
+        self.resumed = None
+        self.total_files = 0
+        self.files_done = 0
+        self.messages_done = 0
+        self.bytes_written = 0
+        self.last_progress = 0
+        self.files_read_ahead = 0
+        self.bytes_read_ahead = 0
+        # Only the main thread is timed, not eg the Prefetcher's threads
+        self.thread = get_ident()
+
+    def install(self):
+        module = globals()
+        for function_names in self.functions.values():
+            for function_name in function_names:
+                class_name, _, name = function_name.rpartition(".")
+                owner = module[class_name] if class_name else None
+                function = getattr(owner, name) if owner else module[name]
+                self.installed.append((owner, name, function))
+                timed = self._timed(function_name, function)
+                if owner:
+                    setattr(owner, name, timed)
+                else:
+                    module[name] = timed
+
+    def uninstall(self):
+        # Put the functions back the way install found them
+        for owner, name, function in reversed(self.installed):
+            if owner:
+                setattr(owner, name, function)
+            else:
+                globals()[name] = function
+        self.installed = []
+
+    def file_done(self, num_sms, bytes_written):
+        self.files_done += 1
+        self.messages_done += num_sms
+        self.bytes_written = bytes_written
+        # Redrawing the line for every file would slow down converting lots of small ones
+        now = time.perf_counter()
+        if now - self.last_progress >= progress_interval or self.files_done == self.total_files:
+            self.last_progress = now
+            end = "\n" if self.files_done == self.total_files else ""
+            print("\r" + self._progress(now), end=end, flush=True)
+
+    def report(self):
+        elapsed = time.perf_counter() - self.start
+        print(f"Converted {self.messages_done} messages in {elapsed:.2f}s")
+        timed = 0
+        for stage, function_names in self.functions.items():
+            stage_seconds = sum(self.seconds.get(name, 0) for name in function_names)
+            timed += stage_seconds
+            print(f"  {stage:<10} {stage_seconds:9.3f}s {stage_seconds / elapsed:6.1%}")
+            for name in function_names:
+                if self.calls.get(name):
+                    print(
+                        f"    {name:<26} {self.seconds[name]:9.3f}s {self.calls[name]:>10} calls"
+                    )
+        other = elapsed - timed
+        print(f"  {'other':<10} {other:9.3f}s {other / elapsed:6.1%}")
+        print(f"Phone number cache: {parse_number.cache_info()}")
+        print(f"Hour cache: {get_hour_start_unix.cache_info()}")
+        print(f"Fallback number files scanned: {len(fallback_files)}")
+        if prefetch_depth:
+            print(
+                f"Read ahead: {self.files_read_ahead} files, "
+                f"{self.bytes_read_ahead / 1024 / 1024:.1f} MB"
+            )
+        peak_memory = get_peak_memory_mb()
+        if peak_memory is not None:
+            print(f"Peak memory: {peak_memory:.0f} MB")
+
+    def _progress(self, now):
+        elapsed = max(now - self.start, 1e-9)
+        files_per_sec = self.files_done / elapsed
+        progress = (
+            f"{self.files_done}/{self.total_files} files, {files_per_sec:.1f} files/s, "
+            f"{self.messages_done / elapsed:.0f} messages/s, "
+            f"{self.bytes_written / 1024 / 1024:.1f} MB written"
+        )
+        if files_per_sec:
+            eta = int((self.total_files - self.files_done) / files_per_sec)
+            progress += f", ETA {eta // 60}:{eta % 60:02d}"
+        peak_memory = get_peak_memory_mb()
+        if peak_memory is not None:
+            progress += f", peak memory {peak_memory:.0f} MB"
+        return progress
+
+    def _timed(self, name, function):
+        self.seconds[name] = 0.0
+        self.calls[name] = 0
+
+        if inspect.isgeneratorfunction(function):
+            # Time each step, not what the caller does in between
+            def timed(*args, **kwargs):
+                self.calls[name] += 1
+                generator = function(*args, **kwargs)
+                while True:
+                    self._enter(name)
+                    try:
+                        value = next(generator)
+                    except StopIteration:
+                        return
+                    finally:
+                        self._exit()
+                    yield value
+
+        else:
+
+            def timed(*args, **kwargs):
+                if get_ident() != self.thread:
+                    return function(*args, **kwargs)
+                self.calls[name] += 1
+                self._enter(name)
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self._exit()
+
+        return timed
+
+    def _enter(self, name):
+        now = time.perf_counter()
+        if self.running:
+            self.seconds[self.running[-1]] += now - self.resumed
+        self.running.append(name)
+        self.resumed = now
+
+    def _exit(self):
+        now = time.perf_counter()
+        self.seconds[self.running.pop()] += now - self.resumed
+        self.resumed = now
+
+
+# What --stats times, by stage. With --jobs, only what the main process does.
+stats_functions = {
+    "walk": ["get_sms_filenames"],
+    "count": ["count_messages"],
+    "parse": ["parse_html", "parse_call_log"],
+    "times": ["get_message_time_unix"],
+    "numbers": ["normalize_number"],
+    "resolve": ["find_attachment", "get_fallback_phone_number", "get_file_index"],
+    "encode": ["encode_attachment"],
+    "write": [
+        "BackupWriter.write",
+        "BackupWriter.write_file",
+        "BackupWriter.flush",
+        "BackupWriter.close",
+    ],
+    "header": ["write_header"],
+    "dedup": ["is_new_message", "DedupIndex.add", "hash_input_file"],
+}
+
+# Seconds between updates of the --stats progress line
+progress_interval = 0.5
+
+# The RunStats for --stats
+run_stats = None
+
+# Print the name of each file as it is converted. --stats shows a progress line instead
+print_file_names = True
+
+
+def get_peak_memory_mb(children=False):
+    # With children, the peak of any worker process that has finished counts too
+    try:
+        import resource
+    except ImportError:
+        # Not available on Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if children:
+        peak = max(peak, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+class BackupWriter:
+    """The output file, opened once and written through a large buffer.
+
+    With background_writer set, the actual writes happen on a separate thread fed through a
+    bounded queue, so formatting the next messages overlaps with writing the previous ones. Use
+    it as a context manager: everything written is flushed and the file closed even when
+    converting fails part way through.
+
+    With output_compression set, everything written is compressed on the way (on the writer
+    thread, if there is one) into a gzip member or zstd frame that follows the ones already in
+    the file. position still counts the bytes before compression. Files that are only read back
+    by the script itself are written with compressed=False.
+    """
+
+    def __init__(self, filename, compressed=True):
+        self.file = open(filename, "ab", buffering=write_buffer_size)
+        # Where the next write will end up in the file, counting anything still queued
+        self.position = self.file.tell()
+        self.compressed = compressed and output_compression is not None
+        self.compressor = None
+        self.queue = None
+        self.error = None
+        if background_writer:
+            self.queue = Queue(maxsize=write_queue_size)
+            self.thread = Thread(target=self._write_queued, daemon=True)
+            self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, text):
+        # Newlines are written the same way a text mode file would
+        if os.linesep != "\n":
+            text = text.replace("\n", os.linesep)
+        self.write_bytes(text.encode("utf8"))
+
+    def write_bytes(self, data):
+        self.position += len(data)
+        self._submit(self._write_data, data)
+
+    def write_file(self, filename, remove=False, uncompressed_size=None):
+        """Append the contents of another file
+
+        With uncompressed_size, the file is another output file, eg a worker's shard, which is
+        already compressed the same way and is copied in as is.
+        """
+        if uncompressed_size is None:
+            self.position += os.path.getsize(filename)
+        else:
+            self.position += uncompressed_size
+        self._submit(self._copy_file, filename, remove, uncompressed_size is not None)
+
+    def end_message(self, date):
+        """Called after each complete <sms> or <mms>, the only places the output may be split or
+        reordered. date is the message's date attribute."""
+
+    def flush(self):
+        if self.queue is not None:
+            self.queue.join()
+        self._raise_error()
+        self.file.flush()
+
+    def close(self):
+        try:
+            if self.queue is not None:
+                self.queue.put((self._end_stream, ()))
+                self.queue.put(None)
+                self.thread.join()
+            else:
+                self._end_stream()
+        finally:
+            self.file.close()
+        self._raise_error()
+
+    def _submit(self, function, *args):
+        if self.queue is None:
+            function(*args)
+        else:
+            self._raise_error()
+            self.queue.put((function, args))
+
+    def _write_data(self, data):
+        if self.compressed:
+            if self.compressor is None:
+                self.compressor = get_compressor()
+            data = self.compressor.compress(data)
+        self.file.write(data)
+
+    def _end_stream(self):
+        # Finish the current gzip member or zstd frame, the next write starts another
+        if self.compressor is not None:
+            self.file.write(self.compressor.flush())
+            self.compressor = None
+
+    def _copy_file(self, filename, remove, is_output):
+        with open(filename, "rb") as source_file:
+            if self.compressed and not is_output:
+                for data in iter(lambda: source_file.read(write_buffer_size), b""):
+                    self._write_data(data)
+            else:
+                # Compressed streams can just be concatenated, once the current one is finished
+                self._end_stream()
+                copyfileobj(source_file, self.file)
+        if remove:
+            os.remove(filename)
+
+    def _write_queued(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                # After a failure keep draining the queue so the converting thread never blocks
+                if self.error is None:
+                    function, args = item
+                    function(*args)
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+class SplitWriter:
+    """The output split over numbered files, eg gvoice-0001.xml, gvoice-0002.xml, ...
+
+    Written like a BackupWriter. After a message, moves on to a new file once the current one has
+    split_size bytes or split_count messages, so each file is at most one message over. Every
+    file gets its own header, with the count filled in as the file is finished.
+    """
+
+    def __init__(self, filename_pattern):
+        self.filename_pattern = filename_pattern
+        self.filenames = []
+        self.file = None
+        self.num_sms = 0
+        # Bytes in the files already finished
+        self.finished_size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def position(self):
+        # Counting every file so far, which is all the manifest needs
+        return self.finished_size + (self.file.position if self.file is not None else 0)
+
+    def write(self, text):
+        self._open().write(text)
+
+    def write_bytes(self, data):
+        self._open().write_bytes(data)
+
+    def write_file(self, filename, remove=False):
+        self._open().write_file(filename, remove)
+
+    def end_message(self, date):
+        self.num_sms += 1
+        if (split_size and self.file.position >= split_size) or (
+            split_count and self.num_sms >= split_count
+        ):
+            self._finish()
+
+    def add_files(self, filenames):
+        """Move finished files from another SplitWriter in as the next ones"""
+        self._finish()
+        for filename in filenames:
+            self.finished_size += os.path.getsize(filename)
+            move(filename, self._next_filename())
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        # Even with no messages at all there is one (empty) file
+        if self.file is None and not self.filenames:
+            self._open()
+        self._finish()
+
+    def _open(self):
+        if self.file is None:
+            filename = self._next_filename()
+            with open(filename, "wb") as sms_backup_file:
+                # Leave room for the count, it gets filled in by write_header in _finish
+                sms_backup_file.write(get_header(0, reserve=True))
+            self.file = BackupWriter(filename)
+            self.num_sms = 0
+        return self.file
+
+    def _finish(self):
+        if self.file is None:
+            return
+        sms_backup_file, self.file = self.file, None
+        with sms_backup_file:
+            sms_backup_file.write("</smses>")
+        self.finished_size += sms_backup_file.position
+        write_header(self.filenames[-1], self.num_sms)
+
+    def _next_filename(self):
+        self.filenames.append(self.filename_pattern.format(len(self.filenames) + 1))
+        return self.filenames[-1]
+
+
+class SortingWriter:
+    """Messages in the order they are converted, to be written out again sorted by date
+
+    Written like a BackupWriter. The messages go to an uncompressed spill file, and the date,
+    offset and length of each is indexed. Every sort_run_length messages, that part of the index
+    is sorted and saved in run_dir, so memory use doesn't grow with the archive. write_sorted
+    merges the runs and copies each message out of the spill file in date order, a chunk at a
+    time. Messages with the same date keep the order they were converted in.
+
+    Without a run_dir, eg for a worker's shard, the whole index is just kept in entries.
+    """
+
+    def __init__(self, filename, run_dir=None):
+        self.filename = filename
+        self.run_dir = run_dir
+        open(filename, "w").close()
+        self.file = BackupWriter(filename, compressed=False)
+        self.message_start = 0
+        self.entries = []
+        self.run_filenames = []
+        self.num_runs = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def position(self):
+        return self.file.position
+
+    def write(self, text):
+        self.file.write(text)
+
+    def write_bytes(self, data):
+        self.file.write_bytes(data)
+
+    def write_file(self, filename, remove=False):
+        self.file.write_file(filename, remove)
+
+    def end_message(self, date):
+        self._add_entry(date, self.message_start, self.file.position - self.message_start)
+        self.message_start = self.file.position
+
+    def add_shard(self, shard_filename, entries):
+        """Append a worker's shard, written by a SortingWriter without a run_dir"""
+        offset = self.file.position
+        self.file.write_file(shard_filename, remove=True)
+        for date, message_offset, length in entries:
+            self._add_entry(date, offset + message_offset, length)
+        self.message_start = self.file.position
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.file.close()
+
+    def write_sorted(self, sms_backup_file):
+        self.close()
+        if self.entries:
+            self._save_run(sorted(self.entries))
+            self.entries = []
+        # Only so many runs are open at once, merge the rest into longer runs first
+        while len(self.run_filenames) > sort_merge_width:
+            run_filenames = self.run_filenames[:sort_merge_width]
+            del self.run_filenames[:sort_merge_width]
+            self._save_run(heapq.merge(*[read_sort_run(name) for name in run_filenames]))
+            for run_filename in run_filenames:
+                os.remove(run_filename)
+
+        with open(self.filename, "rb") as spill_file:
+            runs = [read_sort_run(run_filename) for run_filename in self.run_filenames]
+            for date, offset, length in heapq.merge(*runs):
+                copy_message(spill_file, offset, length, sms_backup_file)
+                sms_backup_file.end_message(date)
+
+    def _add_entry(self, date, offset, length):
+        self.entries.append((date, offset, length))
+        if self.run_dir is not None and len(self.entries) >= sort_run_length:
+            self._save_run(sorted(self.entries))
+            self.entries = []
+
+    def _save_run(self, entries):
+        self.num_runs += 1
+        run_filename = os.path.join(self.run_dir, f"run-{self.num_runs}.idx")
+        with open(run_filename, "wb", buffering=write_buffer_size) as run_file:
+            for entry in entries:
+                run_file.write(sort_entry.pack(*entry))
+        self.run_filenames.append(run_filename)
+
+
+def read_sort_run(run_filename):
+    with open(run_filename, "rb") as run_file:
+        for chunk in iter(lambda: run_file.read(sort_entry.size * 4096), b""):
+            yield from sort_entry.iter_unpack(chunk)
+
+
+# A message's date, offset and length in a SortingWriter index run
+sort_entry = Struct("<qqq")
+
+
+def copy_message(source_file, offset, length, sms_backup_file):
+    """Copy length bytes at offset in source_file to the output, a chunk at a time"""
+    source_file.seek(offset)
+    while length:
+        data = source_file.read(min(length, write_buffer_size))
+        sms_backup_file.write_bytes(data)
+        length -= len(data)
+
+
+class DedupIndex:
+    """Keys of the messages written so far, for --dedup
+
+    The keys live in an SQLite table rather than a set, so millions of messages don't have to fit
+    in memory. Each key is a hash of the message's addresses, date, type, text and attachment
+    digests, see is_new_message. Everything added is one transaction, committed by close once
+    the output is complete, so a run that fails part way leaves a --dedup-index file as it was.
+    The connection is only opened when the first key is added, which is after any --jobs workers
+    have been forked.
+    """
+
+    def __init__(self, filename, temporary=False):
+        self.filename = filename
+        self.temporary = temporary
+        self.connection = None
+        self.duplicates = 0
+
+    def add(self, key):
+        """Add key, returning whether it is new"""
+        if self.connection is None:
+            self._connect()
+        cursor = self.connection.execute("INSERT OR IGNORE INTO message_keys VALUES (?)", (key,))
+        if cursor.rowcount == 0:
+            self.duplicates += 1
+            return False
+        return True
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.commit()
+            self.connection.close()
+            self.connection = None
+
+    def _connect(self):
+        self.connection = sqlite3.connect(self.filename)
+        self.connection.execute(f"PRAGMA cache_size = {-dedup_cache_size // 1024}")
+        if self.temporary:
+            # Nothing to recover if the run fails
+            self.connection.execute("PRAGMA journal_mode = OFF")
+            self.connection.execute("PRAGMA synchronous = OFF")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS message_keys (key BLOB PRIMARY KEY) WITHOUT ROWID"
+        )
+
+
+def is_new_message(*fields):
+    """Whether a message with these --dedup key fields hasn't been written already
+
+    In a worker process the key is only collected, for the main process to check as it adds the
+    shard, so the first copy of a message is always the one kept.
+    """
+    key = hashlib.sha256("\x1f".join(map(str, fields)).encode("utf8")).digest()[:16]
+    if dedup_index is None:
+        message_keys.append(key)
+        return True
+    return dedup_index.add(key)
+
+
+def get_attachment_digest(path):
+    # The same attachment is often in several exports under different paths, so it goes by the
+    # contents
+    return hash_input_file(str(path), *get_input_stat(str(path)))
+
+
+@lru_cache(maxsize=digest_cache_size)
+def hash_input_file(sms_filename, size, mtime):
+    digest = hashlib.sha256()
+    with get_input_path(sms_filename).open("rb") as input_file:
+        for chunk in iter(lambda: input_file.read(part_chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# The DedupIndex for --dedup, in the main process
+dedup_index = None
+
+# The --dedup keys of the messages in a worker's shard, in order
+message_keys = []
+
+
+class MessageStore:
+    """Every message converted, saved in an SQLite database for --store
+
+    read_stored_messages gets them back for --from-store, which writes the output again without
+    parsing any .html files. messages has a row for each message, in the order they were
+    converted, with the address attribute, date, type (msg_box for an MMS), text as it goes in the
+    XML, for an MMS the sender, and the timestamp as Takeout wrote it. addresses has every number
+    in each message in order, indexed for picking out a contact's messages, and parts the content
+    type and input path of each attachment. Like DedupIndex, the connection is only opened when
+    the first message is added.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = None
+        self.num_messages = 0
+        # Start again rather than adding to an earlier run's messages
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    def add(self, message):
+        """Save a MessageRecord"""
+        if self.connection is None:
+            self._connect()
+        self.num_messages += 1
+        message_id = self.num_messages
+        self.connection.execute(
+            "INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                message_id,
+                message.kind,
+                "~".join(message.addresses),
+                message.date,
+                message.type,
+                message.text,
+                message.sender,
+                message.timestamp,
+            ),
+        )
+        self.connection.executemany(
+            "INSERT INTO addresses VALUES (?, ?, ?)",
+            [(message_id, i, address) for i, address in enumerate(message.addresses)],
+        )
+        if message.parts:
+            self.connection.executemany(
+                "INSERT INTO parts VALUES (?, ?, ?, ?)",
+                [
+                    (message_id, i, content_type, str(path))
+                    for i, (content_type, path) in enumerate(message.parts)
+                ],
+            )
+
+    def add_shard(self, filename):
+        """Append the messages in a worker's MessageStore"""
+        if self.connection is None:
+            self._connect()
+        # ATTACH and DETACH can't happen inside a transaction
+        self.connection.commit()
+        self.connection.execute("ATTACH DATABASE ? AS shard", (filename,))
+        offset = self.num_messages
+        for table in ["messages", "addresses", "parts"]:
+            message_id = "id" if table == "messages" else "message_id"
+            self.connection.execute(
+                f"INSERT INTO {table} SELECT {message_id} + ?, "
+                f"{store_columns[table]} FROM shard.{table} ORDER BY {message_id}",
+                (offset,),
+            )
+        (num_messages,) = self.connection.execute("SELECT count(*) FROM shard.messages").fetchone()
+        self.num_messages += num_messages
+        self.connection.commit()
+        self.connection.execute("DETACH DATABASE shard")
+
+    def close(self, indexed=True):
+        if self.connection is None:
+            self._connect()
+        if indexed:
+            # Quicker to build at the end than to keep up to date while adding
+            self.connection.execute("CREATE INDEX messages_by_date ON messages (date)")
+            self.connection.execute("CREATE INDEX addresses_by_address ON addresses (address)")
+        self.connection.commit()
+        self.connection.close()
+        self.connection = None
+
+    def _connect(self):
+        self.connection = sqlite3.connect(self.filename)
+        self.connection.execute(
+            "CREATE TABLE messages (id INTEGER PRIMARY KEY, kind TEXT NOT NULL, address TEXT NOT "
+            "NULL, date INTEGER NOT NULL, type INTEGER NOT NULL, text TEXT NOT NULL, sender TEXT, "
+            "timestamp TEXT)"
+        )
+        self.connection.execute(
+            "CREATE TABLE addresses (message_id INTEGER NOT NULL, position INTEGER NOT NULL, "
+            "address TEXT NOT NULL, PRIMARY KEY (message_id, position)) WITHOUT ROWID"
+        )
+        self.connection.execute(
+            "CREATE TABLE parts (message_id INTEGER NOT NULL, position INTEGER NOT NULL, "
+            "content_type TEXT NOT NULL, path TEXT NOT NULL, PRIMARY KEY (message_id, position)) "
+            "WITHOUT ROWID"
+        )
+
+
+# The columns of each MessageStore table after the message id
+store_columns = {
+    "messages": "kind, address, date, type, text, sender, timestamp",
+    "addresses": "position, address",
+    "parts": "position, content_type, path",
+}
+
+
+def read_stored_messages(filename, after=None, before=None, contacts=()):
+    """The MessageRecords in a MessageStore, in the order they were converted
+
+    after and before are dates in milliseconds, like the date attribute, and contacts are
+    numbers. Only messages from after on, before before and with one of contacts in their
+    addresses are read.
+    """
+    conditions = []
+    parameters = []
+    if after is not None:
+        conditions.append("date >= ?")
+        parameters.append(after)
+    if before is not None:
+        conditions.append("date < ?")
+        parameters.append(before)
+    if contacts:
+        conditions.append(
+            "id IN (SELECT message_id FROM addresses WHERE address IN "
+            f"({', '.join('?' * len(contacts))}))"
+        )
+        parameters += contacts
+    query = "SELECT id, kind, address, date, type, text, sender, timestamp FROM messages"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+
+    connection = sqlite3.connect(filename)
+    try:
+        for message_id, kind, address, date, message_type, text, sender, timestamp in (
+            connection.execute(query + " ORDER BY id", parameters)
+        ):
+            if kind == "sms":
+                yield MessageRecord(
+                    kind, [address], date, message_type, text, sender, [], timestamp
+                )
+                continue
+            addresses = [
+                address
+                for (address,) in connection.execute(
+                    "SELECT address FROM addresses WHERE message_id = ? ORDER BY position",
+                    (message_id,),
+                )
+            ]
+            # The attachments are read from the same place as when they were converted
+            parts = [
+                (content_type, get_input_path(path))
+                for content_type, path in connection.execute(
+                    "SELECT content_type, path FROM parts WHERE message_id = ? ORDER BY position",
+                    (message_id,),
+                )
+            ]
+            yield MessageRecord(
+                kind, addresses, date, message_type, text, sender, parts, timestamp
+            )
+    finally:
+        connection.close()
+
+
+def parse_date_option(parser, option, text):
+    """A --after or --before date in milliseconds, like the date attribute"""
+    import dateutil.parser
+
+    try:
+        date = dateutil.parser.parse(text)
+    except (ValueError, OverflowError):
+        parser.error(f"{option} {text} isn't a date")
+    # The same way get_time_unix converts the message times: the wall clock time as local
+    # standard time, whatever the offset
+    return int(time.mktime(date.replace(tzinfo=None).timetuple()[:8] + (0,)) * 1000)
+
+
+def get_contact_number(contact):
+    import phonenumbers
+
+    # The same form the numbers were saved in, where possible
+    try:
+        return normalize_number(contact)
+    except phonenumbers.phonenumberutil.NumberParseException:
+        return contact
+
+
+def write_messages(sms_backup_file, messages):
+    """Write MessageRecords to the output, returning how many were written"""
+    num_sms = 0
+    for message in messages:
+        num_sms += write_message(sms_backup_file, message)
+    if run_stats:
+        run_stats.messages_done = num_sms
+    return num_sms
+
+
+# The MessageStore for --store. A worker has its own for each shard.
+message_store = None
+
+
+def get_sms_messages(file, messages_raw):
+    """MessageRecords for the messages in a one-to-one conversation or call log file"""
+    fallback_number = 0
+    title_has_number = re.search(r"(^\+[0-9]+)", Path(file).name)
+    if title_has_number:
+        fallback_number = title_has_number.group()
+
+    phone_number, participant_raw = get_first_phone_number(
+        messages_raw, fallback_number
+    )
+
+    # Search similarly named files for a fallback number. This is desperate and expensive, but
+    # hopefully rare. The answer only depends on the contact part of the filename, so it is
+    # remembered for the contact's other files.
+    if phone_number == 0:
+        phone_number, fallback_participant_raw = get_fallback_phone_number(file)
+        if fallback_participant_raw is not None:
+            participant_raw = fallback_participant_raw
+
+    for message in messages_raw:
+        # Check if message has an image in it and treat as mms if so
+        if message.images or message.videos or message.audios:
+            yield from get_mms_messages(file, [participant_raw], [message])
+            continue
+
+        yield MessageRecord(
+            "sms",
+            [str(phone_number)],
+            get_message_time_unix(message),
+            get_message_type(message),
+            get_message_text(message),
+            None,
+            [],
+            message.time,
+        )
+
+
+def write_message(sms_backup_file, message):
+    """Write a MessageRecord, returning 1, or 0 if --dedup dropped it as already written"""
+    if message_store is not None:
+        message_store.add(message)
+    if dedup and not is_new_message(*get_dedup_fields(message)):
+        return 0
+    if message.kind == "sms":
+        write_sms(sms_backup_file, message)
+    else:
+        write_mms(sms_backup_file, message)
+    return 1
+
+
+def get_dedup_fields(message):
+    # The addresses as a set, the time to the millisecond (date is only to the second) and the
+    # attachments by their contents
+    return (
+        message.kind,
+        "~".join(sorted(set(message.addresses))),
+        message.timestamp or message.date,
+        message.type,
+        message.text,
+        *[get_attachment_digest(path) for content_type, path in message.parts],
+    )
+
+
+def write_sms(sms_backup_file, message):
+    sms_values = {
+        "phone": message.addresses[0],
+        "type": message.type,
+        "message": message.text,
+        "time": message.date,
+    }
+    sms_text = (
+        '<sms protocol="0" address="%(phone)s" '
+        'date="%(time)s" type="%(type)s" '
+        'subject="null" body="%(message)s" '
+        'toa="null" sc_toa="null" service_center="null" '
+        'read="1" status="1" locked="0" /> \n' % sms_values
+    )
+    sms_backup_file.write(sms_text)
+    sms_backup_file.end_message(message.date)
+
+
+def get_fallback_phone_number(file):
+    contact = Path(file).stem.split("-")[0]
+    if contact not in fallback_phone_numbers:
+        fallback_phone_numbers[contact] = find_fallback_phone_number(contact)
+    return fallback_phone_numbers[contact]
+
+
+def find_fallback_phone_number(contact):
+    index = get_file_index()
+    phone_number, participant_raw = 0, None
+
+    for fallback_file in index.starting_with(contact, ".html"):
+        phone_number, participant_raw = scan_fallback_file(fallback_file)[0]
+        if phone_number != 0:
+            return phone_number, participant_raw
+
+    # Start looking in the Placed/Received files for a fallback number
+    for fallback_file in index.starting_with(f"{contact}- ", ".html"):
+        vcards = scan_fallback_file(fallback_file)[1]
+        phone_number_ff = 0
+        for vcard in vcards:
+            phone_number_ff = vcard[4:]
+        phone_number, participant_raw = get_first_phone_number([], phone_number_ff)
+        if phone_number != 0:
+            break
+
+    return phone_number, participant_raw
+
+
+def scan_fallback_file(fallback_file):
+    # A Placed/Received file matches the searches for several contacts' files, so each file is
+    # only parsed once
+    key = str(fallback_file)
+    if key not in fallback_files:
+        conversation = parse_takeout_file(fallback_file)
+        fallback_files[key] = (
+            get_first_phone_number(conversation.messages, 0),
+            conversation.vcards,
+        )
+    return fallback_files[key]
+
+
+fallback_phone_numbers = {}
+fallback_files = {}
+
+
+def get_mms_messages(file, participants_raw, messages_raw):
+    """MessageRecords for the messages in a group conversation file, or for messages with
+    attachments"""
+    participants = get_participant_phone_numbers(participants_raw)
+
+    for message in messages_raw:
+        # Sometimes the sender tel field is blank. Try to guess the sender from the participants.
+        sender = get_mms_sender(message, participants)
+        sent_by_me = sender not in participants
+
+        # Find every attachment before writing anything, so a missing one can't leave half an
+        # <mms> behind
+        parts = []
+
+        # Handle images
+        for image in message.images:
+            # I have only encountered jpg and gif, but I have read that GV can ecxport png
+            supported_types = ["jpg", "png", "gif"]
+            image_path = find_attachment(image, supported_types, file, "images")
+            image_type = image_path.suffix[1:]
+            image_type = "jpeg" if image_type == "jpg" else image_type
+            parts.append((f"image/{image_type}", image_path))
+
+        # Handle videos
+        for video in message.videos:
+            supported_types = ["mp4", "3gp"]
+            video_path = find_attachment(video, supported_types, file, "videos")
+            video_type = video_path.suffix[1:]
+            video_type = "3gpp" if video_type == "3pg" else video_type
+            parts.append((f"video/{video_type}", video_path))
+
+        # Handle audios
+        for audio in message.audios:
+            supported_types = ["mp3", "amr"]
+            audio_path = find_attachment(audio, supported_types, file, "audios")
+            audio_type = audio_path.suffix[1:]
+            audio_type = "mpeg" if audio_type == "mp3" else audio_type
+            parts.append((f"audio/{audio_type}", audio_path))
+
+        yield MessageRecord(
+            "mms",
+            participants,
+            get_message_time_unix(message),
+            2 if sent_by_me else 1,
+            get_message_text(message),
+            sender,
+            parts,
+            message.time,
+        )
+
+
+def write_mms(sms_backup_file, message):
+    participants = message.addresses
+    sender = message.sender
+    time = message.date
+    msg_box = message.type
+    sent_by_me = msg_box == 2
+    m_type = 128 if sent_by_me else 132
+    participants_text = "~".join(participants)
+    participants_xml = ""
+    for participant in participants:
+        participant_is_sender = participant == sender or (sent_by_me and participant == "Me")
+        participant_values = {
+            "number": participant,
+            "code": 137 if participant_is_sender else 151,
+        }
+        participants_xml += (
+            '    <addr address="%(number)s" charset="106" type="%(code)s"/> \n'
+            % participant_values
+        )
+
+    sms_backup_file.write(
+        f'<mms address="{participants_text}" ct_t="application/vnd.wap.multipart.related" '
+        f'date="{time}" m_type="{m_type}" msg_box="{msg_box}" read="1" '
+        'rr="129" seen="1" sub_id="-1" text_only="1"> \n'
+        "  <parts> \n"
+        f'    <part ct="text/plain" seq="0" text="{message.text}"/> \n'
+    )
+    for content_type, path in message.parts:
+        write_part(sms_backup_file, content_type, path)
+    sms_backup_file.write(
+        "  </parts> \n"
+        "  <addrs> \n"
+        f"{participants_xml}"
+        "  </addrs> \n"
+        "</mms> \n"
+    )
+    sms_backup_file.end_message(time)
+
+
+def write_part(sms_backup_file, content_type, path):
+    sms_backup_file.write(
+        f'    <part seq="0" ct="{content_type}" name="{path.name}" '
+        f'chset="null" cd="null" fn="null" cid="&lt;{path.name}&gt;" '
+        f'cl="{path.name}" ctt_s="null" ctt_t="null" text="null" '
+        'data="'
+    )
+    attachment_cache = get_attachment_cache()
+    if attachment_cache is None:
+        for data in encode_attachment(path):
+            sms_backup_file.write(data)
+    else:
+        attachment_cache.write(sms_backup_file, path)
+    sms_backup_file.write('" />\n')
+
+
+def encode_attachment(path):
+    # Encode the attachment a chunk at a time so large videos never have to fit in memory. The
+    # chunks are a multiple of 3 bytes, so their base64 concatenates without any padding between.
+    with open_input(path) as fb:
+        for chunk in iter(lambda: fb.read(part_chunk_size), b""):
+            yield b64encode(chunk).decode("ascii")
+
+
+class AttachmentCache:
+    """Base64 encoded attachments already written, by path, size and modification time.
+
+    The same file is often attached to several messages, eg in the repeated foo(0).html,
+    foo(1).html conversation files. Once it has been encoded, it is copied in again from here
+    instead of being read and encoded again. Up to max_size bytes are kept in memory, dropping the
+    least recently used first. With a spill_dir, an attachment too big for that is kept in a file
+    there instead.
+    """
+
+    def __init__(self, max_size, spill_dir=None):
+        self.max_size = max_size
+        self.spill_dir = spill_dir
+        self.encoded = OrderedDict()
+        self.size = 0
+        self.spilled = {}
+        # Attachments written from here, and how many bytes of them didn't have to be read
+        self.reused = 0
+        self.bytes_saved = 0
+
+    def write(self, sms_backup_file, path):
+        key = (str(path),) + get_input_stat(str(path))
+        if key in self.encoded:
+            self.encoded.move_to_end(key)
+            sms_backup_file.write(self.encoded[key])
+        elif key in self.spilled:
+            sms_backup_file.write_file(self.spilled[key])
+        else:
+            self._encode(sms_backup_file, path, key)
+            return
+        self.reused += 1
+        self.bytes_saved += key[1]
+
+    def holds(self, path):
+        key = (str(path),) + get_input_stat(str(path))
+        return key in self.encoded or key in self.spilled
+
+    def _encode(self, sms_backup_file, path, key):
+        chunks = []
+        encoded_size = 0
+        spill_file = None
+        try:
+            for data in encode_attachment(path):
+                sms_backup_file.write(data)
+                if spill_file is not None:
+                    spill_file.write(data)
+                elif chunks is not None:
+                    chunks.append(data)
+                    encoded_size += len(data)
+                    if encoded_size > self.max_size:
+                        # Too big to keep in memory
+                        if self.spill_dir is not None:
+                            spill_filename = os.path.join(
+                                self.spill_dir, f"{os.getpid()}-{len(self.spilled)}.b64"
+                            )
+                            spill_file = open(spill_filename, "w", encoding="ascii")
+                            spill_file.write("".join(chunks))
+                        chunks = None
+        finally:
+            if spill_file is not None:
+                spill_file.close()
+
+        if spill_file is not None:
+            self.spilled[key] = spill_filename
+        elif chunks is not None:
+            while self.size + encoded_size > self.max_size:
+                _, dropped = self.encoded.popitem(last=False)
+                self.size -= len(dropped)
+            self.encoded[key] = "".join(chunks)
+            self.size += encoded_size
+
+
+attachment_cache = None
+attachment_cache_pid = None
+
+
+def get_attachment_cache():
+    global attachment_cache, attachment_cache_pid
+    if attachment_cache_size == 0 and attachment_spill_dir is None:
+        return None
+    # Each worker process keeps its own
+    if attachment_cache is None or attachment_cache_pid != os.getpid():
+        attachment_cache = AttachmentCache(attachment_cache_size, attachment_spill_dir)
+        attachment_cache_pid = os.getpid()
+    return attachment_cache
+
+
+class Prefetcher:
+    """Reads the .html files coming up, and their attachments, on background threads
+
+    Converting a file mostly keeps the CPU busy and reading one mostly waits on the disk, so
+    reading the next few while the current one is converted lets the two overlap. Keeps
+    prefetch_depth files ahead of the one being converted, with at most prefetch_budget bytes read
+    and not used yet. Anything that doesn't fit is left to be read as usual. The attachments are
+    found by looking for src and href attributes in the file, before it is parsed.
+
+    open_input hands out what has been read. Whatever was read for a file and not used is dropped
+    once the next one starts.
+    """
+
+    # Every attachment type find_attachment is asked for
+    media_types = ["jpg", "png", "gif", "mp4", "3gp", "mp3", "amr"]
+
+    # Links in a .html file, other than eg tel: and http: ones
+    media_pattern = re.compile(rb'\b(?:src|href)="([^":]+)"')
+
+    def __init__(self, sms_filenames):
+        self.sms_filenames = sms_filenames
+        # Made here, so the threads don't race to make them
+        get_file_index()
+        self.attachment_cache = get_attachment_cache()
+        self.executor = ThreadPoolExecutor(prefetch_threads, thread_name_prefix="prefetch")
+        self.lock = Lock()
+        # The read of each path, by str(path), and the paths read for each file in sms_filenames
+        self.reads = {}
+        self.file_keys = {}
+        # Bytes read or being read and not used yet
+        self.buffered = 0
+        self.current = -1
+        self.submitted = 0
+        self.closed = False
+        # Files used from memory instead of being read by the conversion, for --stats
+        self.files_used = 0
+        self.bytes_used = 0
+
+    def advance(self, index):
+        """Called as the file at index in sms_filenames starts being converted"""
+        with self.lock:
+            self.current = index
+            dropped = []
+            for done in [done for done in self.file_keys if done < index]:
+                for key in self.file_keys.pop(done):
+                    if key in self.reads:
+                        dropped.append(self.reads.pop(key))
+        for future in dropped:
+            if not future.cancel():
+                future.add_done_callback(self._release)
+
+        while self.submitted < min(index + 1 + prefetch_depth, len(self.sms_filenames)):
+            sms_filename, _ = self.sms_filenames[self.submitted]
+            future = self._submit(self.submitted, get_input_path(sms_filename))
+            if future is not None:
+                future.add_done_callback(
+                    partial(self._find_attachments, self.submitted, sms_filename)
+                )
+            self.submitted += 1
+
+    def take(self, path):
+        """The contents of path if they were read ahead, otherwise None"""
+        with self.lock:
+            future = self.reads.pop(str(path), None)
+        # One that hasn't started yet is quicker to read here than to wait for
+        if future is None or future.cancel():
+            return None
+        data = future.result()
+        if data is not None:
+            self._release(future)
+            self.files_used += 1
+            self.bytes_used += len(data)
+        return data
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            futures = list(self.reads.values())
+            self.reads.clear()
+        for future in futures:
+            future.cancel()
+        self.executor.shutdown()
+
+    def _submit(self, index, path):
+        key = str(path)
+        with self.lock:
+            if self.closed or index < self.current or key in self.reads:
+                return None
+            future = self.executor.submit(self._read, path)
+            self.reads[key] = future
+            self.file_keys.setdefault(index, []).append(key)
+        return future
+
+    def _read(self, path):
+        # Anything that goes wrong happens again when the file is converted, and is reported then
+        try:
+            size = get_input_stat(str(path))[0]
+        except Exception:
+            return None
+        with self.lock:
+            if self.buffered + size > prefetch_budget:
+                return None
+            self.buffered += size
+        try:
+            with path.open("rb") as input_file:
+                data = input_file.read()
+        except Exception:
+            data = None
+        with self.lock:
+            self.buffered -= size - (len(data) if data is not None else 0)
+        return data
+
+    def _release(self, future):
+        data = None if future.cancelled() else future.result()
+        if data is not None:
+            with self.lock:
+                self.buffered -= len(data)
+
+    def _find_attachments(self, index, sms_filename, future):
+        # Runs on a prefetch thread once the file has been read
+        data = None if future.cancelled() else future.result()
+        if data is None:
+            return
+        for name in dict.fromkeys(self.media_pattern.findall(data)):
+            try:
+                name = unescape(name.decode("utf8"))
+                path = find_attachment(name, self.media_types, sms_filename, "attachments")
+                if self.attachment_cache is not None and self.attachment_cache.holds(path):
+                    continue
+            except Exception:
+                # Not an attachment after all, or one the conversion will report missing
+                continue
+            self._submit(index, path)
+
+
+# The Prefetcher reading ahead of the file being converted, with --prefetch
+prefetcher = None
+
+
+def open_input(path, mode="rb", encoding=None):
+    """Open one of the Takeout files for reading, from memory if the Prefetcher has read it"""
+    data = prefetcher.take(path) if prefetcher is not None else None
+    if data is None:
+        return path.open(mode, encoding=encoding)
+    if "b" in mode:
+        return BytesIO(data)
+    return TextIOWrapper(BytesIO(data), encoding=encoding)
+
+
+def find_attachment(filename, supported_types, file, kind):
+    index = get_file_index()
+    original_filename = filename
+    # Each attachment found should only match a single file
+    path = prefer_nearby(index.ending_with(filename), file)
+
+    if len(path) == 0:
+        # Sometimes they just forget the extension
+        for supported_type in supported_types:
+            path = prefer_nearby(index.ending_with(f"{filename}.{supported_type}"), file)
+            if len(path) == 1:
+                break
+
+    if len(path) == 0:
+        # Sometimes the first word doesn't match (eg it is a phone number instead of a contact
+        # name) so try again without the first word
+        filename = "-".join(original_filename.split("-")[1:])
+        path = prefer_nearby(index.containing(filename), file)
+
+    if len(path) == 0:
+        # Sometimes the attachment filename matches the message filename instead of the filename
+        # in the HTML. And sometimes the message filenames are repeated, eg filefoo(0).html,
+        # filefoo(1).html, etc., but the attachment filename matches just the base ("filefoo" in
+        # this example).
+        filenames = [Path(file).stem, Path(file).stem.split("(")[0]]
+        for filename in filenames:
+            # Have to guess at the file extension in this case
+            for supported_type in supported_types:
+                path = prefer_nearby(index.containing(filename, supported_type), file)
+                # Sometimes there's extra cruft in the filename in the HTML. So try to match a
+                # subset of it.
+                if len(path) > 1:
+                    for ip in path:
+                        if ip.stem in original_filename:
+                            path = [ip]
+                            break
+
+                if len(path) == 1:
+                    break
+            if len(path) == 1:
+                break
+
+    assert (
+        len(path) != 0
+    ), f"No matching {kind} found. File name: {original_filename}"
+    assert (
+        len(path) == 1
+    ), f"Multiple potential matching {kind} found. {kind.capitalize()}: {[x for x in path]!r}"
+
+    return path[0]
+
+
+def prefer_nearby(paths, file):
+    """Narrow several matches down to the ones in the same directory as the conversation file
+
+    Several Takeout exports extracted side by side, or given as --zip archives, have the same
+    attachments, and a conversation's own are next to it.
+    """
+    if len(paths) < 2:
+        return paths
+    directory = os.path.dirname(os.path.abspath(file))
+    nearby = [path for path in paths if os.path.dirname(os.path.abspath(str(path))) == directory]
+    return nearby or paths
+
+
+class FileIndex:
+    """Every file and directory below root, collected in a single walk.
+
+    Answers the "**/*name" style patterns used to find attachments and the "**/name*" patterns
+    used to find sibling conversation files, with the results in the same order Path.glob would
+    return them. Patterns that aren't plain names are still handed to Path.glob so the matching
+    rules stay exactly the same.
+
+    Can also be built from the members of Takeout .zip archives instead of a directory, in which
+    case the results are ZipMembers in archive order.
+    """
+
+    def __init__(self, root=None, members=None):
+        self.root = root
+        self.paths = []
+        self.names = []
+        if members is None:
+            self.make_path = Path
+            self._walk(str(root))
+        else:
+            self.make_path = lambda member: member
+            self.paths = members
+            self.names = [os.path.normcase(member.name) for member in members]
+
+        # Names ending with a given suffix are a contiguous range once the names are reversed and
+        # sorted
+        suffix_index = sorted((name[::-1], i) for i, name in enumerate(self.names))
+        self.suffix_keys = [key for key, _ in suffix_index]
+        self.suffix_positions = [i for _, i in suffix_index]
+        prefix_index = sorted((name, i) for i, name in enumerate(self.names))
+        self.prefix_keys = [key for key, _ in prefix_index]
+        self.prefix_positions = [i for _, i in prefix_index]
+        self.substring_matches = {}
+
+    def _walk(self, directory):
+        # Same order as Path.glob("**/*"): a directory's own entries, then each subdirectory in
+        # turn. Symlinked directories aren't followed.
+        try:
+            with os.scandir(directory) as scandir_it:
+                entries = list(scandir_it)
+        except PermissionError:
+            return
+
+        subdirs = []
+        for entry in entries:
+            self.paths.append(entry.path)
+            self.names.append(os.path.normcase(entry.name))
+            try:
+                if entry.is_dir() and not entry.is_symlink():
+                    subdirs.append(entry.path)
+            except OSError:
+                pass
+
+        for subdir in subdirs:
+            self._walk(subdir)
+
+    def ending_with(self, suffix):
+        """Same as list(root.glob(f"**/*{suffix}"))"""
+        if not is_plain_name(suffix):
+            return self._glob(f"*{suffix}")
+
+        return [self.make_path(self.paths[i]) for i in self._ending_with(os.path.normcase(suffix))]
+
+    def containing(self, text, extension=None):
+        """Same as list(root.glob(f"**/*{text}*")), or f"**/*{text}*.{extension}" if given"""
+        pattern = f"*{text}*" if extension is None else f"*{text}*.{extension}"
+        if text == "" or not is_plain_name(text) or not is_plain_name(extension or ""):
+            return self._glob(pattern)
+
+        if pattern not in self.substring_matches:
+            text = os.path.normcase(text)
+            if extension is None:
+                matches = [i for i, name in enumerate(self.names) if text in name]
+            else:
+                suffix = os.path.normcase(f".{extension}")
+                matches = [
+                    i
+                    for i in self._ending_with(suffix)
+                    if text in self.names[i][: -len(suffix)]
+                ]
+            self.substring_matches[pattern] = matches
+
+        return [self.make_path(self.paths[i]) for i in self.substring_matches[pattern]]
+
+    def starting_with(self, prefix, suffix):
+        """Same as list(root.glob(f"**/{prefix}*{suffix}"))"""
+        if not is_plain_name(prefix) or not is_plain_name(suffix):
+            return self._glob(f"{prefix}*{suffix}")
+
+        prefix = os.path.normcase(prefix)
+        suffix = os.path.normcase(suffix)
+        matches = []
+        i = bisect_left(self.prefix_keys, prefix)
+        while i < len(self.prefix_keys) and self.prefix_keys[i].startswith(prefix):
+            name = self.prefix_keys[i]
+            if name.endswith(suffix) and len(name) >= len(prefix) + len(suffix):
+                matches.append(self.prefix_positions[i])
+            i += 1
+        return [self.make_path(self.paths[i]) for i in sorted(matches)]
+
+    def _glob(self, pattern):
+        if self.root is not None:
+            return list(self.root.glob(f"**/{pattern}"))
+        return [member for member in self.paths if fnmatch(member.name, pattern)]
+
+    def _ending_with(self, suffix):
+        key = suffix[::-1]
+        matches = []
+        i = bisect_left(self.suffix_keys, key)
+        while i < len(self.suffix_keys) and self.suffix_keys[i].startswith(key):
+            matches.append(self.suffix_positions[i])
+            i += 1
+        return sorted(matches)
+
+
+file_index = None
+file_index_pid = None
+
+
+def get_file_index():
+    global file_index, file_index_pid
+    # A forked worker has to build its own, since it can't share the parent's open archives
+    if file_index is None or file_index_pid != os.getpid():
+        if takeout_zips:
+            file_index = FileIndex(members=list(get_zip_members().values()))
+        else:
+            file_index = FileIndex(Path(os.path.abspath(takeout_root)))
+        file_index_pid = os.getpid()
+    return file_index
+
+
+class ZipMember:
+    """A file inside a Takeout .zip archive, usable where a Path to the extracted file would be"""
+
+    def __init__(self, archive, info):
+        self.archive = archive
+        self.info = info
+        path = PurePosixPath(info.filename)
+        self.name = path.name
+        self.stem = path.stem
+        self.suffix = path.suffix
+
+    def open(self, mode="r", encoding=None):
+        member_file = self.archive.open(self.info)
+        if "b" in mode:
+            return member_file
+        return TextIOWrapper(member_file, encoding=encoding)
+
+    def stat(self):
+        return self.info.file_size, time.mktime(self.info.date_time + (0, 0, -1))
+
+    def __str__(self):
+        return os.path.join(self.archive.filename, self.info.filename)
+
+    def __repr__(self):
+        return f"ZipMember({self.archive.filename!r}, {self.info.filename!r})"
+
+
+zip_members = None
+zip_members_pid = None
+
+
+def get_zip_members():
+    # Every file in the --zip archives in order, by the name they are given in place of a path
+    global zip_members, zip_members_pid
+    if zip_members is None or zip_members_pid != os.getpid():
+        zip_members = {}
+        for zip_filename in takeout_zips:
+            archive = ZipFile(zip_filename)
+            for info in archive.infolist():
+                if not info.is_dir():
+                    member = ZipMember(archive, info)
+                    zip_members[str(member)] = member
+        zip_members_pid = os.getpid()
+    return zip_members
+
+
+def get_input_path(sms_filename):
+    if takeout_zips:
+        return get_zip_members()[sms_filename]
+    return Path(sms_filename)
+
+
+def get_input_stat(sms_filename):
+    """Size and modification time of one of the .html files"""
+    if takeout_zips:
+        return get_zip_members()[sms_filename].stat()
+    stat = os.stat(sms_filename)
+    return stat.st_size, stat.st_mtime
+
+
+def is_plain_name(name):
+    # Anything glob would treat specially
+    return not any(c in name for c in "*?[/" + os.sep)
+
+
+# What main() needs from a Takeout .html file, pulled out in one go by one of the html_parsers
+# below so the rest of the script doesn't depend on how the file was parsed. Links are the raw
+# "tel:..." href text and media are the raw src/href text.
+Conversation = namedtuple("Conversation", ["messages", "participants", "call_logs", "vcards"])
+# messages and call_logs: the class="message" and class="haudio" elements. cite is the first
+# <cite> and contributor the first class="contributor" element inside. has_span is whether there
+# is a <span> anywhere inside, text is the contents of the <q> and time is the title of the
+# class="dt" (or class="published" for call logs) element.
+Message = namedtuple(
+    "Message",
+    ["cite", "contributor", "has_span", "text", "time", "images", "videos", "audios"],
+)
+Sender = namedtuple("Sender", ["href", "text", "has_span"])
+
+
+def parse_html(path):
+    return html_parsers[html_parser](path)
+
+
+def parse_html_soup(path):
+    from bs4 import BeautifulSoup
+
+    with open_input(path, "r", encoding="utf8") as sms_file:
+        soup = BeautifulSoup(sms_file, "html.parser")
+
+    return Conversation(
+        messages=[get_soup_message(message) for message in soup.find_all(class_="message")],
+        participants=[
+            get_soup_href(participant)
+            for participant_set in soup.find_all(class_="participants")
+            for participant in participant_set
+            if hasattr(participant, "a")
+        ],
+        call_logs=[get_soup_message(message) for message in soup.find_all(class_="haudio")],
+        vcards=[get_soup_href(vcard) for vcard in soup.find_all(class_="contributor vcard")],
+    )
+
+
+def get_soup_message(message):
+    time_raw = message.find(class_="dt")
+    if not time_raw:
+        # Try call log format
+        time_raw = message.find(class_="published")
+
+    return Message(
+        cite=get_soup_sender(message.cite),
+        contributor=get_soup_sender(message.find(class_="contributor")),
+        has_span=message.span is not None,
+        text=str(message.find("q")).strip()[3:-4],
+        time=time_raw.get("title") if time_raw else None,
+        images=[image.get("src") for image in message.find_all("img")],
+        videos=[video.get("href") for video in message.find_all("a", class_="video")],
+        audios=[audio.get("src") for audio in message.find_all("audio")],
+    )
+
+
+def get_soup_sender(sender):
+    if sender is None:
+        return None
+    return Sender(href=get_soup_href(sender), text=sender.text, has_span=sender.span is not None)
+
+
+def get_soup_href(element):
+    return element.a.get("href") if element.a else None
+
+
+def parse_html_lxml(path):
+    # Roughly several times faster than html.parser and no BeautifulSoup tree. Gives the same
+    # records for the well formed XHTML in Takeout archives.
+    import lxml.html
+    from lxml import etree
+
+    with open_input(path) as sms_file:
+        root = lxml.html.parse(sms_file, lxml.html.HTMLParser(encoding="utf-8")).getroot()
+
+    conversation = Conversation([], [], [], [])
+    # One pass over the document to find everything main() looks at
+    for element in root.iter(tag=etree.Element):
+        classes = element.get("class", "").split()
+        if "message" in classes:
+            conversation.messages.append(get_lxml_message(element))
+        if "participants" in classes:
+            conversation.participants.extend(
+                get_lxml_href(participant)
+                for participant in element.iterchildren(tag=etree.Element)
+            )
+        if "haudio" in classes:
+            conversation.call_logs.append(get_lxml_message(element))
+        if classes == ["contributor", "vcard"]:
+            conversation.vcards.append(get_lxml_href(element))
+
+    return conversation
+
+
+def get_lxml_message(message):
+    from lxml import etree
+
+    cite = contributor = time_raw = published = q = None
+    has_span = False
+    images, videos, audios = [], [], []
+    for element in message.iterdescendants(tag=etree.Element):
+        tag = element.tag
+        classes = element.get("class", "").split()
+        if tag == "cite" and cite is None:
+            cite = element
+        elif tag == "q" and q is None:
+            q = element
+        elif tag == "span":
+            has_span = True
+        elif tag == "img":
+            images.append(element.get("src"))
+        elif tag == "audio":
+            audios.append(element.get("src"))
+        elif tag == "a" and "video" in classes:
+            videos.append(element.get("href"))
+
+        if "contributor" in classes and contributor is None:
+            contributor = element
+        if "dt" in classes and time_raw is None:
+            time_raw = element
+        if "published" in classes and published is None:
+            published = element
+
+    if time_raw is None:
+        # Try call log format
+        time_raw = published
+
+    return Message(
+        cite=get_lxml_sender(cite),
+        contributor=get_lxml_sender(contributor),
+        has_span=has_span,
+        text=(get_soup_html(q) if q is not None else "None").strip()[3:-4],
+        time=time_raw.get("title") if time_raw is not None else None,
+        images=images,
+        videos=videos,
+        audios=audios,
+    )
+
+
+def get_lxml_sender(sender):
+    if sender is None:
+        return None
+    return Sender(
+        href=get_lxml_href(sender),
+        text="".join(sender.itertext()),
+        has_span=next(sender.iterdescendants("span"), None) is not None,
+    )
+
+
+def get_lxml_href(element):
+    a = next(element.iterdescendants("a"), None)
+    return a.get("href") if a is not None else None
+
+
+def get_soup_html(element):
+    """element serialized the way str() of the same BeautifulSoup element would be"""
+    html = []
+    append_soup_html(element, html)
+    return "".join(html)
+
+
+def append_soup_html(element, html):
+    from lxml import etree
+
+    if element.tag is etree.Comment:
+        html.append(f"<!--{element.text}-->")
+    elif isinstance(element.tag, str):
+        html.append(f"<{element.tag}")
+        # BeautifulSoup's formatter writes the attributes sorted by name
+        for name, value in sorted(element.items()):
+            if name in soup_multi_valued_attributes:
+                value = " ".join(value.split())
+            html.append(f" {name}={get_soup_attribute(value)}")
+
+        children = list(element)
+        if element.tag in soup_void_elements and not element.text and not children:
+            html.append("/>")
+        else:
+            html.append(">")
+            if element.text:
+                html.append(get_soup_text(element.text))
+            for child in children:
+                append_soup_html(child, html)
+            html.append(f"</{element.tag}>")
+
+    if element.tail and element.getparent() is not None:
+        html.append(get_soup_text(element.tail))
+
+
+def get_soup_text(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def get_soup_attribute(value):
+    value = get_soup_text(value)
+    if '"' not in value:
+        return f'"{value}"'
+    if "'" not in value:
+        return f"'{value}'"
+    return '"' + value.replace('"', "&quot;") + '"'
+
+
+# Matching BeautifulSoup's html.parser tree builder
+soup_void_elements = {
+    "area", "base", "basefont", "bgsound", "br", "col", "command", "embed", "frame", "hr",
+    "image", "img", "input", "isindex", "keygen", "link", "menuitem", "meta", "nextid", "param",
+    "source", "spacer", "track", "wbr",
+}
+soup_multi_valued_attributes = {
+    "class", "rel", "rev", "accept-charset", "headers", "accesskey", "dropzone",
+}
+
+html_parsers = {"html.parser": parse_html_soup, "lxml": parse_html_lxml}
+
+# Which of html_parsers reads the .html files
+html_parser = "html.parser"
+
+
+def parse_takeout_file(path):
+    # Call logs have a fixed, tiny layout that doesn't need a whole parse
+    if get_file_category(path.name) in call_log_categories:
+        return parse_call_log(path)
+    return parse_html(path)
+
+
+def get_file_category(file):
+    """Which kind of Takeout file this is, going by its name
+
+    eg "Contact - Text - 2020-01-01T10_00_00Z.html" is "text" and "Group Conversation -
+    2020-01-01T10_00_00Z.html" is "group". Anything else is "other".
+    """
+    if file.startswith("Group Conversation"):
+        return "group"
+    match = takeout_file_category.match(file)
+    return match.group(1).lower() if match else "other"
+
+
+takeout_file_category = re.compile(r".* - (Text|Placed|Received|Missed|Voicemail) - ")
+file_categories = ["text", "group", "placed", "received", "missed", "voicemail", "other"]
+call_log_categories = {"placed", "received", "missed", "voicemail"}
+
+
+def parse_call_log(path):
+    # Gives the same records as parse_html_soup for a file holding class="haudio" elements and
+    # their vcards. Anything it doesn't expect to find in a call log is handed to parse_html.
+    reader = CallLogReader()
+    with open_input(path, "r", encoding="utf8") as sms_file:
+        reader.feed(sms_file.read())
+    reader.close()
+    if reader.unexpected:
+        return parse_html(path)
+    return Conversation([], [], reader.call_logs, reader.vcards)
+
+
+class CallLogReader(HTMLParser):
+    """Picks the call logs out of a file as the tokenizer passes them, without building a tree
+
+    Opening and closing tags are matched up the way BeautifulSoup's html.parser tree builder
+    does it. unexpected is set if the file has anything that would need the full parser, eg
+    messages or a <q>.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.call_logs = []
+        self.vcards = []
+        self.unexpected = False
+        # Tag names of the open elements
+        self.open_tags = []
+        # The open class="haudio" element and what has been found in it so far
+        self.call_log = None
+        # Open <cite>, class="contributor" and class="contributor vcard" elements still waiting
+        # for their first <a>, or collecting their text
+        self.senders = []
+        self.pending_vcards = []
+
+    def handle_starttag(self, tag, attrs):
+        self.open_tags.append(tag)
+        depth = len(self.open_tags)
+        # Like BeautifulSoup, the last of any repeated attributes wins and a bare attribute is ""
+        attributes = {name: "" if value is None else value for name, value in attrs}
+        classes = attributes.get("class", "").split()
+
+        if "message" in classes or "participants" in classes or tag == "q":
+            self.unexpected = True
+        if " ".join(classes) == "contributor vcard":
+            self.pending_vcards.append((depth, len(self.vcards)))
+            self.vcards.append(None)
+        if tag == "a":
+            # The first <a> inside every vcard still open
+            for _, vcard in self.pending_vcards:
+                self.vcards[vcard] = attributes.get("href")
+            self.pending_vcards = []
+
+        call_log = self.call_log
+        if call_log is not None:
+            if "haudio" in classes:
+                self.unexpected = True
+            for sender in self.senders:
+                if tag == "a" and not sender["has_a"]:
+                    sender["has_a"] = True
+                    sender["href"] = attributes.get("href")
+                if tag == "span":
+                    sender["has_span"] = True
+            if tag == "cite" and call_log["cite"] is None:
+                call_log["cite"] = self._start_sender(depth)
+            if "contributor" in classes and call_log["contributor"] is None:
+                call_log["contributor"] = self._start_sender(depth)
+            if tag == "span":
+                call_log["has_span"] = True
+            if "dt" in classes and "dt" not in call_log:
+                call_log["dt"] = attributes.get("title")
+            if "published" in classes and "published" not in call_log:
+                call_log["published"] = attributes.get("title")
+            if tag == "img":
+                call_log["images"].append(attributes.get("src"))
+            if tag == "a" and "video" in classes:
+                call_log["videos"].append(attributes.get("href"))
+            if tag == "audio":
+                call_log["audios"].append(attributes.get("src"))
+        elif "haudio" in classes:
+            self.call_log = {
+                "depth": depth,
+                "cite": None,
+                "contributor": None,
+                "has_span": False,
+                "images": [],
+                "videos": [],
+                "audios": [],
+            }
+
+        if tag in soup_void_elements:
+            self._close(depth)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in soup_void_elements:
+            self._close(len(self.open_tags))
+
+    def handle_endtag(self, tag):
+        # Closes the most recent open element with the same name and everything inside it. An
+        # end tag with nothing to close is ignored.
+        for depth in range(len(self.open_tags), 0, -1):
+            if self.open_tags[depth - 1] == tag:
+                self._close(depth)
+                return
+
+    def handle_data(self, data):
+        for sender in self.senders:
+            sender["text"].append(data)
+
+    def handle_entityref(self, name):
+        self._unexpected_text()
+
+    def handle_charref(self, name):
+        self._unexpected_text()
+
+    def unknown_decl(self, data):
+        self._unexpected_text()
+
+    def _unexpected_text(self):
+        # Sender text is only ever compared with "Me", so leave anything but plain text to the
+        # full parser
+        if self.senders:
+            self.unexpected = True
+
+    def _start_sender(self, depth):
+        sender = {"depth": depth, "has_a": False, "href": None, "text": [], "has_span": False}
+        self.senders.append(sender)
+        return sender
+
+    def _close(self, depth):
+        # Close the element at depth (counting from 1) and everything open inside it
+        del self.open_tags[depth - 1:]
+        self.senders = [sender for sender in self.senders if sender["depth"] < depth]
+        self.pending_vcards = [vcard for vcard in self.pending_vcards if vcard[0] < depth]
+
+        call_log = self.call_log
+        if call_log is not None and call_log["depth"] >= depth:
+            self.call_logs.append(
+                Message(
+                    cite=get_call_log_sender(call_log["cite"]),
+                    contributor=get_call_log_sender(call_log["contributor"]),
+                    has_span=call_log["has_span"],
+                    text="",
+                    time=call_log["dt"] if "dt" in call_log else call_log.get("published"),
+                    images=call_log["images"],
+                    videos=call_log["videos"],
+                    audios=call_log["audios"],
+                )
+            )
+            self.call_log = None
+
+
+def get_call_log_sender(sender):
+    if sender is None:
+        return None
+    return Sender(href=sender["href"], text="".join(sender["text"]), has_span=sender["has_span"])
+
+
+def get_message_type(message):  # author_raw = messages_raw[i].cite
+    author_raw = message.cite
+    if not author_raw:
+        return 1  # Someone else
+
+    if not author_raw.has_span:
+        return 2  # Me
+    else:
+        return 1  # Someone else
+
+
+def get_message_text(message):
+    return escape(message.text)
+
+
+def get_message_time_unix(message):
+    ymdhms = message.time
+    return get_time_unix(ymdhms)
+
+
+def get_time_unix(ymdhms):
+    # Fast path for the format Takeout uses, eg 2020-01-02T03:04:05.678-05:00. The wall clock time
+    # is converted as local standard time, exactly like mktime on isoparse's timetuple (which has
+    # tm_isdst=0 for any timestamp with an offset). Within an hour that only depends on the
+    # minutes and seconds, so the start of each hour is worked out once and remembered.
+    match = takeout_timestamp.fullmatch(ymdhms)
+    if match:
+        hour_start = get_hour_start_unix(*match.group(1, 2, 3, 4))
+        if hour_start is not None:
+            return int((hour_start + int(match.group(5)) * 60 + int(match.group(6))) * 1000)
+
+    import dateutil.parser
+
+    time_obj = dateutil.parser.isoparse(ymdhms)
+    mstime = time.mktime(time_obj.timetuple()) * 1000
+    return int(mstime)
+
+
+takeout_timestamp = re.compile(
+    r"(\d{4})-(\d{2})-(\d{2})T(\d{2}):([0-5]\d):([0-5]\d)(?:[.,]\d+)?"
+    r"(?:Z|[+-](?:[01]\d|2[0-3])(?::?[0-5]\d)?)"
+)
+
+
+@lru_cache(maxsize=hour_cache_size)
+def get_hour_start_unix(year, month, day, hour):
+    try:
+        hour_start = datetime(int(year), int(month), int(day), int(hour))
+    except ValueError:
+        # Let isoparse deal with it, eg 24:00
+        return None
+    return time.mktime(hour_start.timetuple()[:8] + (0,))
+
+
+def get_mms_sender(message, participants):
+    if message.cite:
+        sender = message.cite
+    else:
+        sender = message.contributor
+
+    number_text = sender.href[4:]
+
+    if number_text != "":
+        number = normalize_number(number_text)
+    else:
+        assert (
+            len(participants) == 1
+        ), "Unable to determine sender in mms with multiple participants"
+        number = participants[0]
+    return number
+
+
+def get_first_phone_number(messages, fallback_number):
+    import phonenumbers
+
+    # handle group messages
+    for author_raw in messages:
+        contributor = author_raw.contributor
+        if contributor:
+            sender_data = contributor
+        elif author_raw.has_span:
+            sender_data = author_raw.cite
+
+            # Skip if first number is Me
+            if sender_data.text == "Me":
+                continue
+        else:
+            continue
+
+        phonenumber_text = sender_data.href[4:]
+
+        # Sometimes the first entry is missing a phone number
+        if phonenumber_text == "":
+            continue
+
+        try:
+            phone_number = normalize_number(phonenumber_text)
+        except phonenumbers.phonenumberutil.NumberParseException:
+            return phonenumber_text, sender_data.href
+
+        # sender_data's link can be used as participant for mms
+        return phone_number, sender_data.href
+
+    # fallback case, use number from filename
+    if fallback_number != 0 and len(fallback_number) >= 7:
+        fallback_number = normalize_number(fallback_number)
+    # Create dummy participant
+    return fallback_number, f"tel:{fallback_number}"
+
+
+def get_participant_phone_numbers(participants_raw):
+    import phonenumbers
+
+    participants = []
+
+    for participant in participants_raw:
+        phone_number_text = participant[4:]
+        if phone_number_text == "" or phone_number_text == "0":
+            phone_number_text = " +00000000000"
+
+        try:
+            participants.append(normalize_number(phone_number_text))
+        except phonenumbers.phonenumberutil.NumberParseException:
+            participants.append(phone_number_text)
+
+    return participants
+
+
+def get_header(numsms, reserve=False):
+    count = str(numsms)
+    if reserve:
+        # Pad after the attribute so any count up to header_count_width digits can be written over
+        # it later without moving the rest of the file
+        assert len(count) <= header_count_width, f"Message count too large: {count}"
+        count += '"' + " " * (header_count_width - len(count))
+    else:
+        count += '"'
+    return get_stored_frame(
+        b"<?xml version='1.0' encoding='UTF-8' standalone='yes' ?>\n"
+        b"<!--Converted from GV Takeout data -->\n"
+        + bytes(f"<smses count=\"{count}>\n", encoding="utf8")
+    )
+
+
+def write_header(filename, numsms):
+    # The header was written with a fixed width count field when the output file was created, so
+    # just overwrite it in place. The output file can be huge, so never copy it.
+    with open(filename, "r+b") as backup_file:
+        backup_file.write(get_header(numsms, reserve=True))
+
+
+def get_stored_frame(data):
+    """data as it goes at the start of the output file
+
+    With output_compression, that is a gzip member or zstd frame holding data uncompressed. Its
+    length only depends on the length of data, so write_header can overwrite it in place with
+    the real count once the rest of the (compressed) file is written.
+    """
+    if output_compression == "gzip":
+        return gzip.compress(data, compresslevel=0, mtime=0)
+    if output_compression == "zstd":
+        # Magic number, a single segment frame header giving the content size, then one raw
+        # block and no checksum
+        assert len(data) < 65536 + 256, f"Header too large: {len(data)}"
+        if len(data) < 256:
+            frame_header = bytes([0x20, len(data)])
+        else:
+            frame_header = bytes([0x60]) + (len(data) - 256).to_bytes(2, "little")
+        block_header = (1 | len(data) << 3).to_bytes(3, "little")
+        return b"\x28\xb5\x2f\xfd" + frame_header + block_header + data
+    return data
+
+
+def get_compressor():
+    if output_compression == "gzip":
+        level = -1 if compression_level is None else compression_level
+        # wbits 31 writes a gzip header and trailer around the deflate stream
+        return zlib.compressobj(level, zlib.DEFLATED, 31)
+    import zstandard
+
+    level = 3 if compression_level is None else compression_level
+    return zstandard.ZstdCompressor(level=level).compressobj()
+
+
+def count_messages(sms_filename):
+    # Same tokenizer BeautifulSoup uses with html.parser, without building the tree
+    counter = MessageCounter()
+    with get_input_path(sms_filename).open("r", encoding="utf8") as sms_file:
+        counter.feed(sms_file.read())
+    counter.close()
+    return counter.num_sms
+
+
+class MessageCounter(HTMLParser):
+    """Counts the elements main() converts: class="message" and class="haudio"."""
+
+    def __init__(self):
+        super().__init__()
+        self.num_sms = 0
+
+    def handle_starttag(self, tag, attrs):
+        # Like BeautifulSoup, the last of any repeated attributes wins
+        classes = (dict(attrs).get("class") or "").split()
+        self.num_sms += ("message" in classes) + ("haudio" in classes)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+
+
+def normalize_number(number_text):
+    # Raises NumberParseException just like phonenumbers.parse when the text isn't a number
+    phone_number = parse_number(number_text)
+    if isinstance(phone_number, Exception):
+        raise phone_number.with_traceback(None)
+    return phone_number
+
+
+@lru_cache(maxsize=number_cache_size)
+def parse_number(number_text):
+    # An archive only has a few hundred distinct numbers but they are parsed for nearly every
+    # message, so remember the E.164 form of each, or the exception if it doesn't parse. Hit and
+    # miss counts are in parse_number.cache_info().
+    import phonenumbers
+
+    try:
+        return format_number(phonenumbers.parse(number_text, None))
+    except phonenumbers.phonenumberutil.NumberParseException as e:
+        return e
+
+
+def format_number(phone_number):
+    import phonenumbers
+
+    return phonenumbers.format_number(phone_number, phonenumbers.PhoneNumberFormat.E164)
+
+
+def escape(message):
+    return message.replace("<br/>", "&#10;").replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace("\"", "&quot;").replace("'", "&apos;")
+
+
+if __name__ == "__main__":
+    main()